@@ -49,10 +49,32 @@ __contributors__ = {}
 __url__ = ''
 
 from . import config
+from . import confusables
+from . import expiry
+from . import prefixtree
+from . import maskindex
+from . import hostcache
+from . import metrics
+from . import outqueue
+from . import paste
+from . import storage
+from . import subsume
+from . import transfer
 from . import plugin
 from importlib import reload
 # In case we're being reloaded.
 reload(config)
+reload(confusables)
+reload(expiry)
+reload(prefixtree)
+reload(maskindex)
+reload(hostcache)
+reload(metrics)
+reload(outqueue)
+reload(paste)
+reload(storage)
+reload(subsume)
+reload(transfer)
 reload(plugin)
 # Add more reloads here if you add third-party modules and want them to be
 # reloaded when this plugin is reloaded.  Don't forget to import them as well!
@@ -0,0 +1,193 @@
+###
+# Blacklist - bench.py
+#
+# Synthetic load benchmark.  Drives the plugin's hot paths against a fake
+# irc object with a real IrcState, no network needed.  Run it from the
+# directory holding the plugin, in an environment where Limnoria is
+# installed:
+#
+#     python -m Blacklist.bench [--masks 100000] [--joins 10000] ...
+#
+# Every run uses the same seed, so numbers can be compared between
+# releases on the same machine.
+###
+
+import argparse, random, shutil, tempfile, time
+
+from supybot import conf, ircmsgs, ircutils, irclib
+
+CHANNEL = '#bench'
+TLDS = ('com', 'net', 'org', 'de', 'fr', 'io')
+
+
+class FakeIrc(object):
+    """Just enough of an Irc object for the plugin: a real IrcState and a
+    sink for outgoing messages and replies"""
+
+    def __init__(self, nick='bench'):
+        self.network = 'bench'
+        self.nick = nick
+        self.prefix = f'{nick}!{nick}@bench.example'
+        self.state = irclib.IrcState()
+        self.state.supported['modes'] = 4
+        self.state.supported['maxlist'] = {'b': 100}
+        self.state.supported['targmax'] = 'KICK:4'
+        self.sent = []
+        self.replies = []
+
+    def queueMsg(self, msg):
+        self.sent.append(msg)
+
+    sendMsg = queueMsg
+
+    def feed(self, msg):
+        self.state.addMsg(self, msg)
+
+    def reply(self, s, **kwargs):
+        self.replies.append(s)
+
+    error = reply
+
+    def isNick(self, s):
+        return ircutils.isNick(s)
+
+    def getCallback(self, name):
+        return None
+
+
+def percentile(samples, p):
+    return samples[min(int(p * len(samples)), len(samples) - 1)]
+
+
+def report(name, samples):
+    """Print ops/sec and latency percentiles of a list of durations"""
+    if not samples:
+        return
+    total = sum(samples)
+    samples = sorted(samples)
+    print(f'{name:<24} {len(samples):>8} ops {len(samples) / total:>12.0f} ops/s  '
+          f'p50 {percentile(samples, 0.5) * 1e6:>9.1f}us  '
+          f'p99 {percentile(samples, 0.99) * 1e6:>9.1f}us  '
+          f'max {samples[-1] * 1e6:>9.1f}us')
+
+
+def timed(fn, items):
+    samples = []
+    for item in items:
+        start = time.perf_counter()
+        fn(item)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def host(rng, i):
+    return f'{rng.choice("abcdefghij")}{i}.isp{i % 997}.{rng.choice(TLDS)}'
+
+
+def makeMask(rng, i):
+    """Return a mask shaped like the plugin's banmask types, with a few
+    ranges and account bans mixed in"""
+    kind = rng.random()
+    if kind < 0.4:
+        return f'*!*@{host(rng, i)}'
+    if kind < 0.6:
+        return f'*!*ident{i}@*.isp{i % 997}.{rng.choice(TLDS)}'
+    if kind < 0.75:
+        return f'nick{i}!*@*'
+    if kind < 0.85:
+        return f'*!*@{(i >> 8) % 224 + 1}.{i % 256}.{rng.randrange(256)}.0/24'
+    if kind < 0.99:
+        return f'$a:account{i}'
+    return f'*!*user{i}*@*'
+
+
+def makeJoiner(rng, i, masks):
+    """Return (hostmask, account); about 1% hit a ban"""
+    if rng.random() < 0.01:
+        mask = rng.choice(masks)
+        if mask.startswith('$a:'):
+            return (f'evader{i}!u@cloak/{i}', mask[3:])
+        if '/' in mask:
+            return (f'evader{i}!u@{mask.rsplit(".", 1)[0].split("@")[1]}.7', None)
+        return (mask.replace('*', 'x'), None)
+    if rng.random() < 0.3:
+        return (f'user{i}!~u{i}@{rng.randrange(1, 224)}.{rng.randrange(256)}.'
+                f'{rng.randrange(256)}.{rng.randrange(256)}', None)
+    return (f'user{i}!~u{i}@{host(rng, i + 10 ** 7)}',
+            f'acct{i}' if rng.random() < 0.5 else None)
+
+
+def joinMsg(hostmask, account):
+    return ircmsgs.IrcMsg(prefix=hostmask, command='JOIN',
+                          args=(CHANNEL, account or '*', 'realname'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Blacklist synthetic load benchmark')
+    parser.add_argument('--masks', type=int, default=100000)
+    parser.add_argument('--joins', type=int, default=10000)
+    parser.add_argument('--bans', type=int, default=1000)
+    parser.add_argument('--lists', type=int, default=5)
+    parser.add_argument('--storage', choices=('json', 'journal', 'sharded'), default='json')
+    parser.add_argument('--seed', type=int, default=1)
+    options = parser.parse_args()
+
+    datadir = tempfile.mkdtemp(prefix='blbench')
+    conf.supybot.directories.data.setValue(datadir)
+    config = conf.supybot.plugins.Blacklist
+    config.enabled.setValue(True)
+    config.storage.setValue(options.storage)
+    config.writeDelay.setValue(3600)
+    config.hitsWriteDelay.setValue(3600)
+    config.maxListOutput.setValue(10 ** 9)
+    # Only the plugin's own cost is measured, not the flush timer's
+    config.modeBatchDelay.setValue(3600)
+    from .maskindex import MaskIndex
+    from .plugin import Blacklist
+    from .storage import clean
+    irc = FakeIrc()
+    irc.state.capabilities_ack.add('extended-join')
+    irc.feed(ircmsgs.IrcMsg(prefix=irc.prefix, command='JOIN', args=(CHANNEL, '*', 'bench')))
+    irc.state.channels[CHANNEL].addUser('@' + irc.nick)
+    cb = Blacklist(irc)
+    rng = random.Random(options.seed)
+    try:
+        masks = [makeMask(rng, i) for i in range(options.masks)]
+        now = int(time.time())
+        report('db insert', timed(lambda mask: cb._dbSet(CHANNEL, mask, ['bench', now, 'bench', now + 7200, False]),
+                                  masks))
+        def rebuild(_):
+            cb.index[CHANNEL] = MaskIndex(cb.db[CHANNEL], cb.fold)
+        report('index rebuild', timed(rebuild, range(1)))
+
+        joiners = [makeJoiner(rng, i, masks) for i in range(options.joins)]
+        msgs = [joinMsg(*joiner) for joiner in joiners]
+        def join(msg):
+            irc.feed(msg)
+            cb.doJoin(irc, msg)
+        report('netjoin (cold)', timed(join, msgs))
+        report('netjoin (rejoin)', timed(lambda msg: cb.doJoin(irc, msg), msgs))
+        report('mode/kick flush', timed(lambda _: cb.queue.flushAll(), range(1)))
+
+        users = sorted(irc.state.channels[CHANNEL].users - {irc.nick})[:options.bans]
+        def timer(nick):
+            cb._ban(irc, ircmsgs.privmsg(CHANNEL, 'timer', prefix=irc.prefix), [],
+                    CHANNEL, nick, 30, 'mass ban')
+        report('timer bans', timed(timer, users))
+        report('mode/kick flush', timed(lambda _: cb.queue.flushAll(), range(1)))
+
+        report('list render', timed(lambda _: cb._list(irc, CHANNEL), range(options.lists)))
+        report('db write', timed(lambda _: cb.writer.flush(), range(3)))
+        report('db load', timed(lambda _: clean(cb.store.load()), range(1)))
+        print(f'{len(irc.sent)} lines sent, {len(cb.db.get(CHANNEL, {}))} masks, '
+              f'{len(cb.misses)} cached misses')
+        print(' | '.join(cb.perf.report()))
+    finally:
+        cb.die()
+        shutil.rmtree(datadir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
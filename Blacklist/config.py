@@ -53,6 +53,14 @@ class CurrencyCommand(registry.Integer):
             raise registry.InvalidRegistryValue(f"Number must be between 0 and {max(plugin.Blacklist.banmasks)}.")
         registry.String.setValue(self, num)
 
+class PasteService(registry.OnlySomeStrings):
+    """Valid values are 'termbin', 'http' and 'file'."""
+    validStrings = ('termbin', 'http', 'file')
+
+class StorageMode(registry.OnlySomeStrings):
+    """Valid values are 'json', 'journal', 'sqlite' and 'sharded'."""
+    validStrings = ('json', 'journal', 'sqlite', 'sharded')
+
 Blacklist = conf.registerPlugin('Blacklist')
 
 conf.registerChannelValue(Blacklist, 'enabled',
@@ -74,10 +82,52 @@ conf.registerChannelValue(Blacklist, 'addManualBans',
         registry.Boolean(True, """Sets whether to watch for channel bans directly added by users (not using the bot) to the database."""))
 
 conf.registerChannelValue(Blacklist, 'maxListOutput',
-        registry.NonNegativeInteger(0, """Sets the maximum number of ban entries to display directly in channel. If the banlist exceeds this number, it will be sent to a paste service (termbin.com) instead. Set to 0 to always use paste service."""))
+        registry.NonNegativeInteger(0, """Sets the maximum number of ban entries to display directly in channel. If the banlist exceeds this number, it will be sent to the paste service set in pasteService instead. Set to 0 to always use paste service."""))
+
+conf.registerGlobalValue(Blacklist, 'pasteService',
+        PasteService('termbin', """Sets where long banlists are pasted: 'termbin' (netcat protocol), 'http' (the list is POSTed as the raw request body and the response is the URL) or 'file' (written to a local directory, for offline use)."""))
+
+conf.registerGlobalValue(Blacklist, 'pasteTarget',
+        registry.String('', """Sets the paste destination: host:port for 'termbin', the URL to POST to for 'http', the directory for 'file'. Leave empty for termbin.com:9999 or data/Blacklist/pastes; 'http' has no default and needs a URL here."""))
 
 conf.registerChannelValue(Blacklist, 'ignoredBanMasks',
-        registry.SpaceSeparatedListOfStrings('ChanServ!*@*', 
+        registry.SpaceSeparatedListOfStrings(['ChanServ!*@*'],
         """Space-separated list of hostmask patterns to ignore when tracking manual bans. Bans set by users matching these masks (like services bots) will not be added to the database."""))
 
+conf.registerChannelValue(Blacklist, 'useNetworkList',
+        registry.Boolean(True, """Sets whether joins in a channel are also checked against the network banlist managed with the 'network' commands. Channel entries take precedence over network ones."""))
+
+conf.registerChannelValue(Blacklist, 'banSlotReserve',
+        registry.NonNegativeInteger(3, """Sets how many of the ban slots the server allows (MAXLIST) are left free for bans set by hand. When the channel's banlist would grow past the rest, the least recently used blacklisted masks are lifted from the channel; they stay in the database and are set again when a matching user joins."""))
+
+conf.registerGlobalValue(Blacklist, 'foldConfusables',
+        registry.Boolean(False, """Sets whether nicks in masks and in joining users' hostmasks are folded to a skeleton before matching, so lookalike Unicode characters (e.g. Cyrillic 'а' for 'a') do not get around nick bans. Takes effect when the plugin is reloaded."""))
+
+conf.registerChannelValue(Blacklist, 'modeBatchDelay',
+        registry.Float(0.5, """Sets the number of seconds ban and unban changes are collected for before being sent as multi-mode lines (as many per line as the server's MODES allows). Kicks wait for the bans queued before them."""))
+
+conf.registerGlobalValue(Blacklist, 'joinCacheSize',
+        registry.NonNegativeInteger(10000, """Sets how many recently joined hostmasks that matched no ban are remembered, so repeat joiners are not checked again until the banlist changes. Set to 0 to disable."""))
+
+conf.registerGlobalValue(Blacklist, 'storage',
+        StorageMode('json', """Sets how the database is saved. 'json' rewrites blacklist.json on every change, 'journal' appends each change to blacklist.journal and periodically folds it into blacklist.json, 'sqlite' keeps it, and the mask hit counters, in blacklist.sqlite3, which several bots can share (an existing blacklist.json is imported on first use), 'sharded' keeps one file per channel under shards/, read when the channel is first used and rewritten only when it changes (an existing blacklist.json is split on first use). Takes effect when the plugin is reloaded."""))
+
+conf.registerGlobalValue(Blacklist, 'writeDelay',
+        registry.PositiveFloat(2.0, """Sets the number of seconds changes are collected for before the database is written to disk, so a burst of bans costs a single write."""))
+
+conf.registerGlobalValue(Blacklist, 'hitsWriteDelay',
+        registry.PositiveFloat(60.0, """Sets the number of seconds mask hit counters are collected for before they are written to hits.json, or to the database in 'sqlite' storage mode."""))
+
+conf.registerGlobalValue(Blacklist, 'compactInterval',
+        registry.PositiveInteger(3600, """Sets the number of seconds between folding the journal into blacklist.json in 'journal' storage mode, and between pruning the change history other bots read in 'sqlite' storage mode. Takes effect when the plugin is reloaded."""))
+
+conf.registerGlobalValue(Blacklist, 'compactRecords',
+        registry.NonNegativeInteger(10000, """Sets the number of journal records after which the journal is folded into blacklist.json early in 'journal' storage mode. Set to 0 to only compact on the interval."""))
+
+conf.registerGlobalValue(Blacklist, 'syncInterval',
+        registry.PositiveFloat(5.0, """Sets the number of seconds between picking up changes other bots made to the database in 'sqlite' storage mode. Takes effect when the plugin is reloaded."""))
+
+conf.registerGlobalValue(Blacklist, 'metricsLogInterval',
+        registry.NonNegativeInteger(0, """Sets the number of seconds between logging the statistics shown by the 'metrics' command. Set to 0 to disable. Takes effect when the plugin is reloaded."""))
+
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
@@ -0,0 +1,112 @@
+###
+# Blacklist - confusables.py
+#
+# Skeleton folding for nicks.  Lookalike characters are mapped to one
+# plain representative through a str.translate table, so a ban on a nick
+# also catches its homoglyph spellings.
+###
+
+# Alphanumeric part of the homoglyph table in Useless/confusables.py: each
+# typable character and the Unicode variants that look like it
+confusable = {
+    '0': '߀𝛰〇𐊒𝟬𝜪Oዐ𝞞𝝤ⵔՕ𝟢𝗢𝘖ⲞОΟଠ𝟎𝐎০୦Ｏ𐊫𝙾ꓳ𐐄𝟶𝑶𝚶𐓂௦౦೦ഠဝ၀ჿᴏᴑⲟ０ｏ𐐬𐓪',
+    '1': '𝚕𝟏𝟙𝟣𝟭𝟷',
+    '2': 'Ƨᒿ２𝟐𝟤𝟮𝟸',
+    '3': 'ƷȜЗӠⳌꝪꞫ３',
+    '4': 'Ꮞ𝟒𝟜𝟦𝟰𝟺',
+    '5': 'Ƽ５',
+    '6': 'бᏮⳒ６',
+    '7': '７𐓒',
+    '8': '８𐌚𝟖𝟠𝟪𝟴',
+    '9': '৭୨ⳊꝮ９',
+    'A': 'ΑАᎪᗅᴀꓮꭺＡ𐊠',
+    'B': 'ΒВᏴᗷꓐＢ𐊂𐊡𝐁𝐵𝑩𝔹𝖡𝗕𝘉𝘽𝚩𝜝𝝗𝞑',
+    'C': 'СᏟᑕℂⅭ⊂ⲤꓚＣ𐊢𐐕',
+    'D': 'ᎠᗞᗪⅮꓓꭰＤ𝐃𝐷𝑫𝔻𝖣𝗗𝘋𝘿𝙳',
+    'E': 'ΕЕᎬ⋿ⴹꓰꭼＥ𐊆',
+    'F': 'ϜᖴꓝꞘＦ𐊇𐊥𝟋',
+    'G': 'ɢԌᏀᏳᏻꓖꮐＧ𝐆𝐺𝑮𝔾𝖦𝗚𝘎𝙂𝙶',
+    'H': 'ʜΗНнᎻᕼⲎꓧＨ𐋏𝐇𝐻𝑯𝖧𝗛𝘏𝙃𝚮𝛨𝜢𝝜𝞖',
+    'J': 'ͿЈᎫᒍᴊꓙꞲꭻＪ𝐉𝐽𝑱𝕁𝖩𝗝𝙹',
+    'K': 'ΚКᏦᛕKⲔꓗＫ',
+    'L': 'ʟᏞᒪⅬⳐⳑꓡꮮＬ𐐛𐑃',
+    'M': 'ΜϺМᎷᗰᛖⅯⲘꓟＭ𐊰𐌑𝐌𝑀𝑴𝕄𝖬𝗠𝘔𝙈𝙼𝚳𝛭𝜧𝝡𝞛',
+    'N': 'ɴΝⲚꓠＮ',
+    'O': 'OΟОՕ௦౦೦ഠဝ၀ჿዐᴏᴑⲞⲟⵔ〇ꓳ０Ｏｏ𐊒𐊫𐐄𐐬𐓂𐓪',
+    'P': 'ΡРᏢᑭᴘᴩℙⲢꓑꮲＰ𐊕𝐏𝑃𝑷𝖯𝗣𝘗𝙋𝙿𝚸𝛲𝜬𝝦𝞠',
+    'Q': 'ℚⵕＱ𝐐𝑄𝑸𝖰𝗤𝘘𝙌𝚀',
+    'R': 'ƦʀᎡᏒᖇᚱꓣꭱꮢＲ𐒴',
+    'S': 'ЅՏᏕᏚꓢＳ𐊖𐐠',
+    'T': 'ΤТтᎢᴛ⊤⟙ⲦꓔꭲＴ𐊗𐊱𐌕',
+    'U': 'Սሀᑌ∪⋃ꓴＵ𐓎',
+    'V': 'Ѵ٧۷ᏙᐯⅤⴸꓦꛟＶ',
+    'W': 'ԜᎳᏔꓪＷ',
+    'X': 'ΧХ᙭ᚷⅩ╳ⲬⵝꓫꞳＸ𐊐𐊴𐌗𐌢',
+    'Y': 'ΥϒУҮᎩᎽⲨꓬＹ𐊲',
+    'Z': 'ΖᏃꓜＺ𐋵',
+    'a': 'ɑαа⍺ａ𝐚𝑎𝒂𝕒𝖆𝖺𝗮𝘢𝙖𝚊𝛂𝛼𝜶𝝰𝞪',
+    'b': 'ƄЬᏏᑲᖯｂ𝐛𝑏𝒃𝖇𝖻𝗯𝘣𝙗𝚋',
+    'c': 'ϲсᴄⅽⲥꮯｃ𐐽𝐜𝑐𝒄𝕔𝖈𝖼𝗰𝘤𝙘𝚌',
+    'd': 'ԁᏧᑯⅆⅾꓒｄ𝐝𝑑𝒅𝒹𝓭𝖽𝗱𝘥𝙙𝚍',
+    'e': 'еҽ℮ｅ𝐞𝕖𝖾𝗲𝚎',
+    'f': 'ẝꞙꬵｆ',
+    'g': 'ƍɡցᶃｇ𝐠𝑔𝒈𝕘𝖌𝗀𝗴𝘨𝙜𝚐',
+    'h': 'һᏂℎｈ𝒉𝕙𝗁𝗵𝘩𝙝𝚑',
+    'j': 'ϳјｊ𝐣𝚓',
+    'k': 'ｋ𝐤𝑘𝒌𝕜𝖐𝗄𝗸𝘬𝙠𝚔',
+    'm': 'm𝕞𝙢𝗺ⅿ',
+    'n': 'ոռｎ𝗇𝗻𝘯𝙣𝚗',
+    'o': 'OΟОՕ௦౦೦ഠဝ၀ჿዐᴏᴑⲞⲟⵔ〇ꓳ０Ｏｏ𐊒𐊫𐐄𐐬𐓂𐓪',
+    'p': 'ρϱр⍴ⲣｐ𝑝𝕡𝗉𝗽𝘱𝙥𝚙𝛒𝜌𝝆𝞀𝞺',
+    'q': 'ԛｑ𝐪𝕢𝗊𝗾𝘲𝙦𝚚',
+    'r': 'гᴦⲅꭈꮁｒ𝐫𝗋𝗿𝚛',
+    's': 'ѕꜱꮪｓ𐑈',
+    't': 'ｔ𝘁𝚝',
+    'u': 'ʋυսᴜꭒｕ𐓶',
+    'v': 'νѵᴠⅴ∨⋁ꮩｖ',
+    'w': 'ɯѡԝաᴡꮃｗ',
+    'x': '×хⅹ⤫⤬⨯ｘ𝐱𝑥𝒙𝔵𝕩𝖝𝗑𝘅𝘹𝙭𝚡',
+    'y': 'ɣγуүყỿꭚｙ',
+    'z': 'ᴢꮓｚ𝙯𝗓𝕫𝚣𝒛',
+}
+
+
+def _skeletonTable():
+    """Build the translate table.  Characters sharing a variant (such as
+    '0' and 'o', which both list 'O') end up in one group, and every member
+    of a group maps to the group's smallest plain character."""
+    parent = {}
+    def find(c):
+        while parent.setdefault(c, c) != c:
+            parent[c] = parent[parent[c]]
+            c = parent[c]
+        return c
+    def union(a, b):
+        (a, b) = (find(a), find(b))
+        if a != b:
+            parent[max(a, b)] = min(a, b)
+    for (char, variants) in confusable.items():
+        for variant in variants:
+            union(char, variant)
+    table = {}
+    for c in parent:
+        if c != find(c):
+            table[ord(c)] = find(c)
+    return table
+
+TABLE = _skeletonTable()
+
+
+def skeleton(s):
+    """Fold s to its skeleton: lookalikes replaced, lowercased.  Folding
+    again after lowercasing catches capitals only listed in lowercase."""
+    return s.translate(TABLE).lower().translate(TABLE)
+
+
+def foldNick(hostmask):
+    """Fold the nick part of a hostmask or mask, leaving ident and host
+    untouched"""
+    (nick, sep, rest) = hostmask.partition('!')
+    return skeleton(nick) + sep + rest
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -0,0 +1,83 @@
+###
+# Blacklist - expiry.py
+#
+# Single timer for every ban deadline.  Deadlines sit in a min-heap and one
+# schedule event is kept pointed at the earliest of them.
+###
+
+import heapq, threading, time
+
+from supybot import log, schedule
+
+
+class ExpiryQueue(object):
+    """Min-heap of (expiry, channel, mask) driven by one schedule event.
+
+    fire(due) is called with the list of (expiry, channel, mask) whose time
+    has come.  Entries are never removed from the heap; fire() is expected
+    to ignore deadlines that no longer apply."""
+
+    def __init__(self, fire, name='bl_expiry'):
+        self.fire = fire
+        self.name = name
+        self.heap = []
+        self.next = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def load(self, items):
+        """Replace the heap with items in one go"""
+        with self.lock:
+            self.heap = list(items)
+            heapq.heapify(self.heap)
+            self._reschedule()
+
+    def push(self, when, channel, mask):
+        with self.lock:
+            heapq.heappush(self.heap, (when, channel, mask))
+            if self.next is None or when < self.next:
+                self._reschedule()
+
+    def extend(self, items):
+        """Add many (expiry, channel, mask) at once"""
+        with self.lock:
+            self.heap.extend(items)
+            heapq.heapify(self.heap)
+            if self.heap and (self.next is None or self.heap[0][0] < self.next):
+                self._reschedule()
+
+    def _reschedule(self):
+        if self.next is not None:
+            try: schedule.removeEvent(self.name)
+            except KeyError: pass
+            self.next = None
+        if self.heap:
+            self.next = self.heap[0][0]
+            schedule.addEvent(self._run, self.next, self.name)
+
+    def _run(self):
+        now = time.time()
+        due = []
+        with self.lock:
+            self.next = None
+            while self.heap and self.heap[0][0] <= now:
+                due.append(heapq.heappop(self.heap))
+        try:
+            self.fire(due)
+        except Exception as e:
+            log.exception(f'Blacklist: expiry failed: {e}')
+        with self.lock:
+            if self.next is None:
+                self._reschedule()
+
+    def stop(self):
+        with self.lock:
+            if self.next is not None:
+                try: schedule.removeEvent(self.name)
+                except KeyError: pass
+                self.next = None
+            self.heap = []
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -0,0 +1,61 @@
+###
+# Blacklist - hostcache.py
+#
+# Hostmasks of the users sitting in a channel, kept as one newline-joined
+# blob so a new ban mask can be matched against every user with a single
+# regex scan.  Each blob line is "nick<TAB>hostmask", the hostmask folded
+# when the plugin folds nicks, so the real nick can be read back.
+###
+
+import re
+
+from supybot import ircutils
+
+from .maskindex import compileRange, maskRegex
+from .prefixtree import parseRange
+
+
+class ChannelHosts(object):
+    """nick -> hostmask for one channel, plus a lazily rebuilt blob of all
+    the hostmasks"""
+
+    def __init__(self, hostmasks=(), fold=None):
+        self.hostmasks = ircutils.IrcDict()
+        self.blob = None
+        self.fold = fold or (lambda hostmask: hostmask)
+        for hostmask in hostmasks:
+            self.set(hostmask)
+
+    def __contains__(self, nick):
+        return nick in self.hostmasks
+
+    def __len__(self):
+        return len(self.hostmasks)
+
+    def set(self, hostmask):
+        self.hostmasks[ircutils.nickFromHostmask(hostmask)] = hostmask
+        self.blob = None
+
+    def discard(self, nick):
+        if self.hostmasks.pop(nick, None) is not None:
+            self.blob = None
+
+    def rename(self, old, hostmask):
+        self.hostmasks.pop(old, None)
+        self.set(hostmask)
+
+    def match(self, mask):
+        """Return the nicks of every user mask matches"""
+        parsed = parseRange(self.fold(mask))
+        if parsed is not None:
+            # Address ranges are no regex, test each user instead
+            matcher = compileRange(*parsed)
+            return [hostmask.split('!', 1)[0] for hostmask in self.hostmasks.values()
+                    if matcher(self.fold(hostmask)) is not None]
+        if self.blob is None:
+            self.blob = '\n'.join(f'{hostmask.split("!", 1)[0]}\t{self.fold(hostmask)}'
+                                  for hostmask in self.hostmasks.values())
+        pattern = re.compile(f'^([^\t\n]*)\t{maskRegex(self.fold(mask))}$', re.I | re.M)
+        return [m.group(1) for m in pattern.finditer(self.blob)]
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
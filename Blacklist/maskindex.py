@@ -0,0 +1,269 @@
+###
+# Blacklist - maskindex.py
+#
+# Compiled ban-mask index used on the JOIN path.  Masks are bucketed by the
+# most selective literal part they contain so a joiner is only tested
+# against a handful of candidate patterns instead of the whole banlist.
+###
+
+import collections, re
+
+from supybot import ircutils
+
+from .prefixtree import PrefixTree, parseAddress, parseRange
+
+# Length of the literal nick prefix used as a bucket key
+NICK_PREFIX = 3
+# Number of recently hit masks tried before the buckets
+HOT = 16
+# Extban prefixes naming a services account: Charybdis/Solanum, InspIRCd,
+# UnrealIRCd (old and named forms)
+ACCOUNT_PREFIXES = ('$a:', 'R:', '~a:', '~account:')
+
+
+def _hasWildcard(s):
+    return '*' in s or '?' in s
+
+
+def maskRegex(mask):
+    """Return the regex body for a hostmask pattern, using the same rules
+    (IRC case folding included) as ircutils.hostmaskPatternEqual"""
+    out = []
+    for c in mask:
+        if c == '*':
+            out.append('.*')
+        elif c == '?':
+            out.append('.')
+        elif c in '[{':
+            out.append(r'[\[{]')
+        elif c in '}]':
+            out.append(r'[}\]]')
+        elif c in '|\\':
+            out.append(r'[|\\]')
+        elif c in '^~':
+            out.append('[~^]')
+        else:
+            out.append(re.escape(c))
+    return ''.join(out)
+
+
+def compileMask(mask):
+    """Compile a hostmask pattern into a match function"""
+    return re.compile(maskRegex(mask) + '$', re.I).match
+
+
+def compileRange(user, network):
+    """Compile a range mask, split by prefixtree.parseRange, into a match
+    function for hostmasks inside network whose nick!ident matches user"""
+    userMatch = compileMask(user)
+    def matcher(hostmask):
+        (left, sep, host) = hostmask.rpartition('@')
+        address = parseAddress(host)
+        if address is None or address.version != network.version or \
+          address not in network:
+            return None
+        return userMatch(left)
+    return matcher
+
+
+def accountName(mask):
+    """Return the lowered account an account ban names, None for anything
+    else (wildcard account names included)"""
+    for prefix in ACCOUNT_PREFIXES:
+        if mask.startswith(prefix) and len(mask) > len(prefix):
+            name = mask[len(prefix):]
+            return None if _hasWildcard(name) else ircutils.toLower(name)
+    return None
+
+
+def hostKeys(host):
+    """Return every bucket key a host can be found under: the full host and
+    each of its suffixes starting after a dot"""
+    keys = [host]
+    i = host.find('.')
+    while i != -1:
+        keys.append(host[i+1:])
+        i = host.find('.', i+1)
+    return keys
+
+
+class MaskIndex(object):
+    """Set of ban masks bucketed by literal host suffix, ident or nick prefix.
+
+    Every mask lives in exactly one bucket, picked in that order of
+    preference; masks without a usable literal part go to the wildcard
+    bucket, which is checked for every hostmask.  Address range masks
+    (nick!ident@net/len) live in a prefix tree walked for IP hosts, and
+    account bans in a hash keyed on the account name.  The last few masks passed
+    to touch() are tried first, so a flood of joins from one evader is
+    settled in a comparison or two.
+
+    fold, if given, is applied to masks and hostmasks alike before they are
+    bucketed or matched (see confusables.foldNick)."""
+
+    def __init__(self, masks=(), fold=None):
+        self.fold = fold
+        self.masks = {}   # mask -> (bucket dict, key)
+        self.hosts = {}   # literal host suffix -> {mask: matcher}
+        self.idents = {}  # literal ident -> {mask: matcher}
+        self.nicks = {}   # literal nick prefix -> {mask: matcher}
+        self.wild = {}    # mask -> matcher
+        self.ranges = PrefixTree()
+        self.accounts = {}  # lowered account -> {mask: None}
+        self.hot = collections.OrderedDict()  # mask -> matcher, newest last
+        self.comparisons = 0  # patterns tried by the last match()
+        for mask in masks:
+            self.add(mask)
+
+    def __contains__(self, mask):
+        return mask in self.masks
+
+    def __iter__(self):
+        return iter(self.masks)
+
+    def __len__(self):
+        return len(self.masks)
+
+    def _bucket(self, mask):
+        """Return (bucket dict, key) for mask, key is None for the wildcard
+        bucket"""
+        lowered = ircutils.toLower(mask)
+        if lowered.count('!') != 1 or lowered.count('@') != 1 or \
+          lowered.index('!') > lowered.index('@'):
+            return (None, None)
+        nick, rest = lowered.split('!', 1)
+        ident, host = rest.split('@', 1)
+        if not _hasWildcard(host):
+            return (self.hosts, host)
+        tail = re.split(r'[*?]', host)[-1]
+        if '.' in tail and tail.split('.', 1)[1]:
+            return (self.hosts, tail.split('.', 1)[1])
+        if ident and not _hasWildcard(ident):
+            return (self.idents, ident)
+        if not _hasWildcard(nick):
+            return (self.nicks, nick[:NICK_PREFIX])
+        prefix = re.split(r'[*?]', nick)[0]
+        if len(prefix) >= NICK_PREFIX:
+            return (self.nicks, prefix[:NICK_PREFIX])
+        return (None, None)
+
+    def add(self, mask):
+        if mask in self.masks:
+            return
+        account = accountName(mask)
+        if account is not None:
+            self.accounts.setdefault(account, {})[mask] = None
+            self.masks[mask] = (self.accounts, account)
+            return
+        pattern = self.fold(mask) if self.fold else mask
+        parsed = parseRange(pattern)
+        if parsed is not None:
+            self.ranges.add(parsed[1], mask, compileRange(*parsed))
+            self.masks[mask] = (self.ranges, parsed[1])
+            return
+        (bucket, key) = self._bucket(pattern)
+        matcher = compileMask(pattern)
+        if bucket is None:
+            self.wild[mask] = matcher
+        else:
+            bucket.setdefault(key, {})[mask] = matcher
+        self.masks[mask] = (bucket, key)
+
+    def discard(self, mask):
+        try:
+            (bucket, key) = self.masks.pop(mask)
+        except KeyError:
+            return
+        self.hot.pop(mask, None)
+        if bucket is self.ranges:
+            self.ranges.discard(key, mask)
+        elif bucket is None:
+            del self.wild[mask]
+        else:
+            del bucket[key][mask]
+            if not bucket[key]:
+                del bucket[key]
+
+    def touch(self, mask):
+        """Move mask to the front of the hot list"""
+        if mask not in self.masks:
+            return
+        (bucket, key) = self.masks[mask]
+        if bucket is self.accounts:
+            # Already a single lookup
+            return
+        if bucket is self.ranges:
+            self.hot[mask] = self.ranges.get(key, mask)
+        else:
+            self.hot[mask] = self.wild[mask] if bucket is None else bucket[key][mask]
+        self.hot.move_to_end(mask)
+        while len(self.hot) > HOT:
+            self.hot.popitem(last=False)
+
+    def candidates(self, hostmask):
+        """Yield (mask, matcher) for every pattern that could match
+        hostmask, which must already be folded if the index folds"""
+        lowered = ircutils.toLower(hostmask)
+        if ircutils.isUserHostmask(lowered):
+            (nick, ident, host) = ircutils.splitHostmask(lowered)
+            for key in hostKeys(host):
+                yield from self.hosts.get(key, {}).items()
+            yield from self.idents.get(ident, {}).items()
+            yield from self.nicks.get(nick[:NICK_PREFIX], {}).items()
+            if self.ranges:
+                address = parseAddress(host)
+                if address is not None:
+                    yield from self.ranges.lookup(address)
+        yield from self.wild.items()
+
+    def match(self, hostmask, account=None):
+        """Return the first mask matching hostmask or, if given, the services
+        account, None if there is none"""
+        self.comparisons = 0
+        if account is not None and self.accounts:
+            self.comparisons += 1
+            for mask in self.accounts.get(ircutils.toLower(account), ()):
+                return mask
+        if self.fold:
+            hostmask = self.fold(hostmask)
+        for mask in reversed(self.hot):
+            self.comparisons += 1
+            if self.hot[mask](hostmask) is not None:
+                return mask
+        for (mask, matcher) in self.candidates(hostmask):
+            self.comparisons += 1
+            if matcher(hostmask) is not None:
+                return mask
+        return None
+
+
+class MissCache(object):
+    """Bounded LRU of (channel, hostmask, account) that matched no mask, each tagged
+    with the channel's db generation at the time.  Any banlist change bumps
+    the generation, so stale entries simply stop counting."""
+
+    def __init__(self, size):
+        self.size = size
+        self.data = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.data)
+
+    def hit(self, channel, hostmask, generation, account=None):
+        key = (channel, ircutils.toLower(hostmask), account)
+        if self.data.get(key) != generation:
+            return False
+        self.data.move_to_end(key)
+        return True
+
+    def add(self, channel, hostmask, generation, account=None):
+        size = self.size()
+        if not size:
+            return
+        key = (channel, ircutils.toLower(hostmask), account)
+        self.data[key] = generation
+        self.data.move_to_end(key)
+        while len(self.data) > size:
+            self.data.popitem(last=False)
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -0,0 +1,84 @@
+###
+# Blacklist - metrics.py
+#
+# In-process counters and fixed-bucket histograms for the hot paths, cheap
+# enough to stay on all the time.
+###
+
+import bisect, threading, time
+
+# Bucket upper bounds: 0, then a 1-2-5 series from 0.001 to 5000000
+BOUNDS = [0] + [m * 10 ** e for e in range(-3, 7) for m in (1, 2, 5)]
+
+
+class Histogram(object):
+    """Counts observations per bucket; percentiles are reported as the upper
+    bound of the bucket they fall in, capped by the largest value seen"""
+
+    def __init__(self):
+        self.buckets = [0] * (len(BOUNDS) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, p):
+        if not self.count:
+            return 0
+        rank = p * self.count
+        seen = 0
+        for (i, n) in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(BOUNDS[i], self.max) if i < len(BOUNDS) else self.max
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return 'no data'
+        return (f'n={self.count} avg={self.total / self.count:.3g} '
+                f'p50={self.percentile(0.5):.3g} p99={self.percentile(0.99):.3g} '
+                f'max={self.max:.3g}')
+
+
+class Metrics(object):
+    """Named counters and histograms.  Durations are kept in milliseconds."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+            self.since = time.time()
+
+    def incr(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, value):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(value)
+
+    def elapsed(self, name, start):
+        """Record the milliseconds since start, a time.perf_counter()
+        value"""
+        self.observe(name, (time.perf_counter() - start) * 1000)
+
+    def report(self):
+        """Return one 'name: value' string per counter and histogram"""
+        with self.lock:
+            lines = [f'{name}: {n}' for name, n in sorted(self.counters.items())]
+            lines += [f'{name}: {h.summary()}' for name, h in sorted(self.histograms.items())]
+        return lines
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -0,0 +1,249 @@
+###
+# Blacklist - outqueue.py
+#
+# Per-channel moderation output.  Ban and unban changes are collected for a
+# short window and sent as multi-mode lines sized by the server's MODES
+# ISUPPORT token.  Kicks follow them, packed several nicks per line as
+# TARGMAX allows, so a kick never overtakes the ban that keeps the user out.
+# Lifts of expired bans wait in a separate low priority queue and only go
+# out while nothing else is waiting to be sent.
+###
+
+import collections, threading, time
+
+from supybot import conf, ircmsgs, ircutils, schedule
+
+# Longest line a server will relay, CRLF included
+MAXLINE = 512
+# Shortest wait in seconds between two looks at the lift queue
+PUMP_MIN = 0.1
+
+
+def modeLines(irc, channel, changes):
+    """Pack (mode, mask) changes into as few MODE messages as MODES and the
+    line length allow"""
+    num_modes = irc.state.supported.get('modes', 1) or 1
+    overhead = len(f':{irc.prefix} MODE {channel} \r\n')
+    msgs = []
+    chunk = []
+    for change in changes:
+        candidate = chunk + [change]
+        args = ircutils.joinModes(candidate)
+        if chunk and (len(candidate) > num_modes or
+                      overhead + len(' '.join(args)) > MAXLINE):
+            msgs.append(ircmsgs.mode(channel, ircutils.joinModes(chunk)))
+            candidate = [change]
+        chunk = candidate
+    if chunk:
+        msgs.append(ircmsgs.mode(channel, ircutils.joinModes(chunk)))
+    return msgs
+
+
+def kickTargets(irc):
+    """Return how many nicks one KICK may carry according to TARGMAX, None
+    if the server sets no limit"""
+    targmax = irc.state.supported.get('targmax')
+    if not targmax:
+        return 1
+    for item in targmax.split(','):
+        (name, sep, limit) = item.partition(':')
+        if name.upper() == 'KICK':
+            return int(limit) if limit else None
+    return 1
+
+
+def kickLines(irc, channel, kicks):
+    """Pack (nick, reason) kicks into multi-target KICK messages, keeping
+    their order; only consecutive kicks sharing a reason are merged"""
+    targets = kickTargets(irc)
+    msgs = []
+    nicks = []
+    reason = None
+    for (nick, why) in kicks:
+        if nicks:
+            line = f':{irc.prefix} KICK {channel} {",".join(nicks + [nick])} :{reason}\r\n'
+            if why != reason or (targets and len(nicks) >= targets) or \
+              len(line.encode('utf-8')) > MAXLINE:
+                msgs.append(ircmsgs.kicks(channel, nicks, reason))
+                nicks = []
+        nicks.append(nick)
+        reason = why
+    if nicks:
+        msgs.append(ircmsgs.kicks(channel, nicks, reason))
+    return msgs
+
+
+def backlog(irc):
+    """Return how many lines wait in irc's own send queue"""
+    return len(getattr(irc, 'queue', ()))
+
+
+class ModerationQueue(object):
+    """Pending MODE +b/-b changes and kicks, per channel, and lifts.
+
+    delay(channel) gives the batching window in seconds; the first change
+    queued for a channel schedules its flush.  Lifts (see lift()) are held
+    per network and sent a line at a time, every throttleTime, whenever
+    neither this queue nor the bot's send queue has anything else; a ban
+    flushed for a channel takes that channel's lifts along so they free
+    their slots first.  observe(name, value), if given, is told how many
+    MODE and KICK lines each flush sent."""
+
+    def __init__(self, delay, observe=None):
+        self.delay = delay
+        self.observe = observe
+        self.pending = {}  # (network, channel) -> {'irc', 'modes', 'kicks'}
+        self.lifts = {}    # network -> OrderedDict((channel, mask) -> irc)
+        self.lock = threading.Lock()
+
+    def _entry(self, irc, channel):
+        key = (irc.network, channel)
+        entry = self.pending.get(key)
+        if entry is None:
+            entry = self.pending[key] = {'irc': irc, 'modes': {}, 'kicks': {}}
+            schedule.addEvent(lambda: self.flush(irc, channel),
+                              time.time() + self.delay(channel),
+                              self._eventName(irc, channel))
+        return entry
+
+    def _eventName(self, irc, channel):
+        return f'bl_modes_{irc.network}_{channel}'
+
+    def _liftEvent(self, irc):
+        return f'bl_lifts_{irc.network}'
+
+    def ban(self, irc, channel, mask):
+        with self.lock:
+            self.lifts.get(irc.network, {}).pop((channel, mask), None)
+            self._entry(irc, channel)['modes'][mask] = '+b'
+
+    def unban(self, irc, channel, mask):
+        with self.lock:
+            self.lifts.get(irc.network, {}).pop((channel, mask), None)
+            self._entry(irc, channel)['modes'][mask] = '-b'
+
+    def lift(self, irc, channel, mask):
+        """Queue a low priority -b, for bans that merely ran their time"""
+        with self.lock:
+            entry = self.pending.get((irc.network, channel))
+            if entry is not None and entry['modes'].get(mask) == '+b':
+                del entry['modes'][mask]
+            if entry is not None and mask in entry['modes']:
+                return
+            lifts = self.lifts.setdefault(irc.network, collections.OrderedDict())
+            start = not lifts
+            lifts[(channel, mask)] = irc
+        if start:
+            self._schedulePump(irc)
+
+    def queued(self, irc, channel):
+        """Return {mask: mode} of the changes waiting for channel, lifts
+        included"""
+        with self.lock:
+            queued = {mask: '-b' for (chan, mask) in self.lifts.get(irc.network, {})
+                      if chan == channel}
+            entry = self.pending.get((irc.network, channel))
+            if entry:
+                queued.update(entry['modes'])
+            return queued
+
+    def kick(self, irc, channel, nick, reason):
+        """Queue a kick to go out right after channel's pending modes"""
+        with self.lock:
+            kicks = self._entry(irc, channel)['kicks']
+            kicks.setdefault(ircutils.toLower(nick), (nick, reason))
+
+    def flush(self, irc, channel):
+        with self.lock:
+            entry = self.pending.pop((irc.network, channel), None)
+            try: schedule.removeEvent(self._eventName(irc, channel))
+            except KeyError: pass
+            if entry is not None and '+b' in entry['modes'].values():
+                lifts = self.lifts.get(irc.network, {})
+                for key in [key for key in lifts if key[0] == channel]:
+                    del lifts[key]
+                    entry['modes'].setdefault(key[1], '-b')
+        if entry is None:
+            return
+        bans = irc.state.channels[channel].bans \
+            if channel in irc.state.channels else set()
+        # Drop changes the channel already reflects; unbans first so they
+        # free the slots of a full banlist for the bans
+        changes = [(mode, mask) for mask, mode in entry['modes'].items()
+                   if (mode == '+b') != (mask in bans)]
+        changes.sort(key=lambda change: change[0] != '-b')
+        users = irc.state.channels[channel].users \
+            if channel in irc.state.channels else ()
+        kicks = [kick for kick in entry['kicks'].values() if kick[0] in users]
+        modes = modeLines(irc, channel, changes)
+        kicks = kickLines(irc, channel, kicks)
+        self._send(irc, modes + kicks)
+        if self.observe is not None:
+            self.observe('modeLines', len(modes))
+            self.observe('kickLines', len(kicks))
+
+    def _send(self, irc, msgs):
+        for msg in msgs:
+            # Coalesce with an identical line still waiting to go out
+            if msg not in getattr(irc, 'queue', ()):
+                irc.queueMsg(msg)
+
+    def _schedulePump(self, irc):
+        try: schedule.removeEvent(self._liftEvent(irc))
+        except KeyError: pass
+        # Never spin, even with throttling turned off
+        interval = max(conf.supybot.protocols.irc.throttleTime(), PUMP_MIN)
+        schedule.addEvent(lambda: self._pump(irc), time.time() + interval,
+                          self._liftEvent(irc))
+
+    def _pump(self, irc, force=False):
+        """Send one line of lifts if nothing else is waiting (all of them if
+        force), and come back later for the rest"""
+        while True:
+            with self.lock:
+                lifts = self.lifts.get(irc.network)
+                if not lifts:
+                    return
+                if not force and (backlog(irc) or
+                                  any(key[0] == irc.network for key in self.pending)):
+                    batch = []
+                else:
+                    channel = next(iter(lifts))[0]
+                    size = None if force else (irc.state.supported.get('modes', 1) or 1)
+                    batch = [key for key in lifts if key[0] == channel][:size]
+                    for key in batch:
+                        del lifts[key]
+                again = bool(lifts)
+            if batch:
+                bans = irc.state.channels[channel].bans \
+                    if channel in irc.state.channels else set()
+                modes = modeLines(irc, channel, [('-b', mask) for (chan, mask) in batch
+                                                 if mask in bans])
+                self._send(irc, modes)
+                if self.observe is not None:
+                    self.observe('liftLines', len(modes))
+            if not again:
+                return
+            if not force:
+                self._schedulePump(irc)
+                return
+
+    def depth(self):
+        """Return the number of (mode changes, kicks) waiting"""
+        with self.lock:
+            return (sum(len(entry['modes']) for entry in self.pending.values()) +
+                    sum(len(lifts) for lifts in self.lifts.values()),
+                    sum(len(entry['kicks']) for entry in self.pending.values()))
+
+    def flushAll(self):
+        with self.lock:
+            keys = [(entry['irc'], key[1]) for key, entry in self.pending.items()]
+            ircs = [next(iter(lifts.values())) for lifts in self.lifts.values() if lifts]
+        for (irc, channel) in keys:
+            self.flush(irc, channel)
+        for irc in ircs:
+            try: schedule.removeEvent(self._liftEvent(irc))
+            except KeyError: pass
+            self._pump(irc, force=True)
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -0,0 +1,84 @@
+###
+# Blacklist - paste.py
+#
+# Paste backends for long banlists and a small helper that uploads in the
+# background and hands the URL to a callback.
+###
+
+import hashlib, os, socket, threading
+import urllib.request
+
+from supybot import log
+
+
+def termbin(content, target):
+    """Send content to a termbin-style netcat service at host:port"""
+    (host, sep, port) = target.partition(':')
+    sock = socket.create_connection((host, int(port or 9999)), timeout=10)
+    with sock:
+        sock.sendall(content.encode('utf-8'))
+        sock.shutdown(socket.SHUT_WR)
+        url = b''
+        while True:
+            data = sock.recv(1024)
+            if not data:
+                break
+            url += data
+    # Strip null bytes and whitespace
+    return url.decode('utf-8').rstrip('\x00\n\r ')
+
+
+def http(content, target):
+    """POST content as the raw request body to target (e.g. https://paste.rs/),
+    the response body is the paste URL"""
+    request = urllib.request.Request(target, data=content.encode('utf-8'),
+                                     headers={'Content-Type': 'text/plain; charset=utf-8'})
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return response.read().decode('utf-8').strip()
+
+
+def localFile(content, target):
+    """Write content under the target directory and return the file path,
+    for bots without access to a paste service"""
+    if not os.path.exists(target):
+        os.makedirs(target)
+    name = hashlib.sha1(content.encode('utf-8')).hexdigest()[:12] + '.txt'
+    path = os.path.join(target, name)
+    with open(path, 'w') as f: f.write(content)
+    return path
+
+
+services = {'termbin': termbin, 'http': http, 'file': localFile}
+
+
+class Paster(object):
+    """Runs uploads off the plugin thread.  Requests sharing a key while an
+    upload is in flight wait for that upload instead of starting another."""
+
+    def __init__(self):
+        self.inflight = {}  # key -> [callbacks]
+        self.lock = threading.Lock()
+
+    def upload(self, key, service, target, content, callback):
+        """Upload content and call callback(url) from the upload thread, url
+        is None on failure"""
+        with self.lock:
+            if key in self.inflight:
+                self.inflight[key].append(callback)
+                return
+            self.inflight[key] = [callback]
+        threading.Thread(target=self._run, name='Blacklist paste', daemon=True,
+                         args=(key, service, target, content)).start()
+
+    def _run(self, key, service, target, content):
+        try:
+            url = services[service](content, target) or None
+        except Exception as e:
+            log.error(f'Blacklist: failed to send to {service} paste ({target}): {e}')
+            url = None
+        with self.lock:
+            callbacks = self.inflight.pop(key, [])
+        for callback in callbacks:
+            callback(url)
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -3,11 +3,21 @@
 # V1.11 - Fixed termbin null byte in response
 ###
 
-import json, os, time, threading, re
-import urllib.request, urllib.parse
-
+import os, time, threading, re
 from supybot.commands import *
-from supybot import callbacks, conf, ircmsgs, ircutils, schedule
+from supybot import callbacks, conf, ircmsgs, ircutils, schedule, world
+
+from .confusables import foldNick
+from .expiry import ExpiryQueue
+from .hostcache import ChannelHosts
+from .maskindex import MaskIndex, MissCache, accountName
+from .metrics import Metrics
+from .outqueue import ModerationQueue
+from .paste import Paster
+from .storage import DbWriter, JsonStore, JournalStore, ShardStore, SqliteHitStore, SqliteStore, \
+    clean, deadlines, validEntry
+from .subsume import redundant
+from .transfer import FORMATS, detect, readBans, writeBans
 
 try:
     from supybot.i18n import PluginInternationalization
@@ -17,6 +27,9 @@ except ImportError:
     # without the i18n module
     _ = lambda x: x
 
+# db key of the banlist shared by every channel with useNetworkList on
+GLOBAL = '*'
+
 class Blacklist(callbacks.Plugin):
     """A custom ban tracking plugin to keep a channel's banlist cleaner"""
     
@@ -38,22 +51,414 @@ class Blacklist(callbacks.Plugin):
         self.__parent.__init__(irc)
         self.dbfile = os.path.join(str(conf.supybot.directories.data), 'Blacklist', 'blacklist.json')
         self.db = {}
+        # channel (or GLOBAL) -> MaskIndex, compiled on first use, see _index
+        self.index = {}
+        # channel (or GLOBAL) -> counter bumped whenever a mask is added or
+        # removed, which is all the miss cache cares about
+        self.generation = {}
+        # channel (or GLOBAL) -> counter bumped on any change, entry
+        # details included
+        self.revision = {}
+        self.misses = MissCache(lambda: self.registryValue('joinCacheSize'))
+        # Guards self.db and self.index against the writer thread and
+        # threaded commands
+        self.lock = threading.RLock()
+        self.perf = Metrics()
+        self.fold = foldNick if self.registryValue('foldConfusables') else None
+        if self.registryValue('storage') == 'journal':
+            self.store = JournalStore(self.dbfile, self.registryValue('compactRecords'))
+        elif self.registryValue('storage') == 'sqlite':
+            self.store = SqliteStore(os.path.splitext(self.dbfile)[0] + '.sqlite3')
+        elif self.registryValue('storage') == 'sharded':
+            self.store = ShardStore(self.dbfile, self._shardLoaded)
+        else:
+            self.store = JsonStore(self.dbfile)
+        self.writer = DbWriter(self.store, self._snapshot,
+                               lambda: self.registryValue('writeDelay'),
+                               lambda ms: self.perf.observe('dbWrite', ms))
+        # scope -> {mask: [joins matched, last match]}, saved apart from the
+        # db so counting a hit does not invalidate the miss cache
+        self.hits = {}
+        if self.registryValue('storage') == 'sqlite':
+            # Bots sharing the database share the data directory too, and
+            # would overwrite each other's hits.json
+            hitStore = SqliteHitStore(self.store)
+        else:
+            hitStore = JsonStore(os.path.join(os.path.dirname(self.dbfile), 'hits.json'))
+        self.hitWriter = DbWriter(hitStore, self._hitSnapshot,
+                                  lambda: self.registryValue('hitsWriteDelay'),
+                                  lambda ms: self.perf.observe('hitsWrite', ms))
+        # (channel, mask) -> when the ban is lifted from the channel
+        self._unbanAt = {}
+        # channel -> masks whose lift is due but the channel's banlist is
+        # not known yet (e.g. right after startup)
+        self._pendingLift = {}
+        self.expiries = ExpiryQueue(self._expire)
+        self.queue = ModerationQueue(lambda channel: self.registryValue('modeBatchDelay', channel),
+                                     self.perf.observe)
+        # (network, channel) -> ChannelHosts, seeded from irc.state on first use
+        self.hosts = {}
+        # (network, channel) whose banlist we have seen in full since joining
+        self._banlists = set()
+        # (channel, mask) -> when we last set mask in channel
+        self._lastHit = {}
+        self.paster = Paster()
+        # channel -> ((revision, service, target), url) of the last paste
+        self.pastes = {}
         self._initdb()
+        self.writer.start()
+        self.hitWriter.start()
+        self._loadExpiries()
+        if self.registryValue('storage') in ('journal', 'sqlite'):
+            # Nothing to compact in the other modes, where it would only
+            # rewrite an unchanged database
+            schedule.addPeriodicEvent(self.writer.requestCompact,
+                                      self.registryValue('compactInterval'),
+                                      'bl_compact', now=False)
+        if self.registryValue('metricsLogInterval'):
+            schedule.addPeriodicEvent(self._logMetrics,
+                                      self.registryValue('metricsLogInterval'),
+                                      'bl_metrics', now=False)
+        if self.registryValue('storage') == 'sqlite':
+            schedule.addPeriodicEvent(self._pull, self.registryValue('syncInterval'),
+                                      'bl_sync', now=False)
+    
+    def die(self):
+        try: schedule.removeEvent('bl_compact')
+        except KeyError: pass
+        try: schedule.removeEvent('bl_metrics')
+        except KeyError: pass
+        try: schedule.removeEvent('bl_sync')
+        except KeyError: pass
+        self.expiries.stop()
+        self.queue.flushAll()
+        if getattr(self.store, 'journal', None):
+            # Fold the journal in on the way out, so blacklist.json is
+            # complete if the bot comes back in another storage mode.
+            # Not isinstance(): on reload the module already holds the
+            # new JournalStore class
+            self.writer.requestCompact()
+        self.writer.stop()
+        self.hitWriter.stop()
+        self.store.close()
+        self.__parent.die()
     
     def _initdb(self):
         try:
-            with open(self.dbfile, 'r') as f: self.db = json.load(f)
+            self.db = self.store.load()
         except IOError:
             self._dbWrite()
+        dropped = clean(self.db)
+        if dropped:
+            self.log.warning(f'Blacklist: dropped {dropped} malformed entries from the database.')
+            self._dbWrite()
+        try:
+            self.hits = self.hitWriter.store.load()
+        except (IOError, ValueError):
+            self.hits = {}
+    
+    def _dbSet(self, channel, mask, entry, record=True):
+        """Store a banlist entry and add its mask to the channel index;
+        record=False for changes that came from the store itself"""
+        with self.lock:
+            if mask not in self.db.get(channel, {}):
+                self.generation[channel] = self.generation.get(channel, 0) + 1
+            self.revision[channel] = self.revision.get(channel, 0) + 1
+            self.db.setdefault(channel, {})[mask] = entry
+            if channel in self.index:
+                self.index[channel].add(mask)
+            if record:
+                self.store.record(channel, mask, entry)
+    
+    def _dbDel(self, channel, mask, record=True):
+        """Drop a banlist entry and its mask from the channel index"""
+        with self.lock:
+            del self.db[channel][mask]
+            if channel in self.index:
+                self.index[channel].discard(mask)
+            self.generation[channel] = self.generation.get(channel, 0) + 1
+            self.revision[channel] = self.revision.get(channel, 0) + 1
+            if record:
+                self.store.record(channel, mask, None)
+            self._lastHit.pop((channel, mask), None)
+            self.hits.get(channel, {}).pop(mask, None)
+            if len(self.db[channel]) == 0:
+                del self.db[channel]
+                self.index.pop(channel, None)
     
-    def _write(self, lock):
-        if not os.path.exists(os.path.dirname(self.dbfile)):
-            os.mkdir(os.path.dirname(self.dbfile))
-        with lock, open(self.dbfile, 'w') as f: json.dump(self.db, f)
+    def _dbBulk(self, scope, entries):
+        """Store many entries at once: the index is rebuilt once, on next
+        use, and the store gets a single write"""
+        with self.lock:
+            self.db.setdefault(scope, {}).update(entries)
+            for (mask, entry) in entries.items():
+                self.store.record(scope, mask, entry)
+            self.generation[scope] = self.generation.get(scope, 0) + 1
+            self.revision[scope] = self.revision.get(scope, 0) + 1
+            self.index.pop(scope, None)
+        self._dbWrite()
+    
+    def _index(self, scope):
+        """Return the mask index of scope, compiling it the first time the
+        scope is matched against; None if scope has no banlist"""
+        with self.lock:
+            index = self.index.get(scope)
+            masks = self.db.get(scope) if index is None else None
+            if masks is not None:
+                start = time.perf_counter()
+                index = self.index[scope] = MaskIndex(masks, self.fold)
+                self.perf.elapsed('indexBuild', start)
+            return index
+    
+    def _snapshot(self, scopes=None):
+        """Return a copy of the db, or of just the given scopes, that is
+        safe to serialise off-thread"""
+        with self.lock:
+            if scopes is None:
+                return {channel: {mask: list(v) for mask, v in masks.items()}
+                        for channel, masks in self.db.items()}
+            copy = {}
+            for scope in scopes:
+                masks = self.db.get(scope)
+                if masks is not None:
+                    copy[scope] = {mask: list(v) for mask, v in masks.items()}
+            return copy
     
     def _dbWrite(self):
-        lock = threading.Lock()
-        threading.Thread(target=self._write,args=(lock,)).start()
+        self.writer.markDirty()
+    
+    def _hitSnapshot(self):
+        with self.lock:
+            return {scope: {mask: list(h) for mask, h in masks.items()}
+                    for scope, masks in self.hits.items() if masks}
+    
+    def _recordHit(self, scope, mask):
+        """Count a join matched by mask; saved with the next hits write"""
+        with self.lock:
+            if mask not in self.db.get(scope, {}):
+                return
+            hit = self.hits.setdefault(scope, {}).setdefault(mask, [0, 0])
+            hit[0] += 1
+            hit[1] = int(time.time())
+            self._index(scope).touch(mask)
+        self.hitWriter.markDirty()
+    
+    def _pull(self):
+        """Apply the changes other bots sharing the database made since the
+        last pull"""
+        try:
+            changes = self.store.changes()
+        except Exception as e:
+            self.log.error(f'Blacklist: failed to read changes from {self.store.path}: {e}')
+            return
+        if changes is None:
+            self.log.warning('Blacklist: missed changes to the shared database, reloading it.')
+            self._reload()
+            return
+        for (channel, mask, entry) in changes:
+            with self.lock:
+                if entry is None:
+                    if mask in self.db.get(channel, {}):
+                        self._dbDel(channel, mask, record=False)
+                    continue
+                if not validEntry(entry):
+                    continue
+                self._dbSet(channel, mask, entry, record=False)
+            if len(entry) >= 5 and entry[4]:
+                self.expiries.push(entry[3], channel, mask)
+        if changes:
+            self.log.debug(f'Blacklist: picked up {len(changes)} changes from the shared database.')
+    
+    def _reload(self):
+        """Replace the db with the store's current contents"""
+        self.writer.flush()
+        db = self.store.load()
+        clean(db)
+        with self.lock:
+            for channel in set(self.db) | set(db):
+                self.generation[channel] = self.generation.get(channel, 0) + 1
+                self.revision[channel] = self.revision.get(channel, 0) + 1
+            self.db = db
+            self.index = {}
+        self._loadExpiries()
+    
+    def _loadExpiries(self):
+        """Rebuild the expiry heap from the stored expiry timestamps.
+        Anything already overdue fires as soon as the scheduler runs."""
+        with self.lock:
+            items = self._deadlines(deadlines(self.db))
+        self.expiries.load(items)
+    
+    def _deadlines(self, stored):
+        """Return the expiry queue items for stored (channel, mask, expiry,
+        timed) deadlines, noting when normal bans are to be lifted"""
+        items = []
+        for (channel, mask, when, timed) in stored:
+            if not timed:
+                if channel == GLOBAL:
+                    # Lifted per channel, see do368
+                    continue
+                self._unbanAt[(channel, mask)] = when
+            items.append((when, channel, mask))
+        return items
+    
+    def _shardLoaded(self, scope, masks):
+        """Queue the deadlines of a banlist read from its shard on first
+        use; those that are overdue fire at once"""
+        with self.lock:
+            items = self._deadlines((scope, mask, v[3], len(v) >= 5 and bool(v[4]))
+                                    for mask, v in masks.items() if len(v) >= 4)
+        self.expiries.extend(items)
+    
+    def _scheduleLift(self, channel, mask, when, scope=None):
+        """Lift mask from channel at when; for normal channel bans the time
+        is kept in the db so it survives a restart.  scope is the banlist
+        the entry lives in when it is not channel's own (i.e. GLOBAL)"""
+        scope = scope or channel
+        with self.lock:
+            v = self.db.get(scope, {}).get(mask)
+            if v is not None and len(v) >= 5 and v[4]:
+                # A timed ban leaves the channel when it expires anyway
+                when = min(when, v[3])
+            elif scope == channel and v is not None and len(v) >= 4 and v[3] != int(when):
+                self._dbSet(channel, mask, v[:3] + [int(when)] + v[4:])
+                self._dbWrite()
+            self._unbanAt[(channel, mask)] = when
+        self.expiries.push(when, channel, mask)
+    
+    def _expire(self, due):
+        now = time.time()
+        for (when, channel, mask) in due:
+            with self.lock:
+                v = self.db.get(channel, {}).get(mask)
+                if v is not None and len(v) >= 5 and v[4] and v[3] <= now:
+                    # TIMED BAN: remove from channel AND database
+                    self._dbDel(channel, mask)
+                    self._unbanAt.pop((channel, mask), None)
+                    self._dbWrite()
+                elif self._unbanAt.get((channel, mask), now+1) <= now:
+                    # NORMAL BAN: remove from channel, keep in database
+                    del self._unbanAt[(channel, mask)]
+                else:
+                    # Removed or re-applied since this deadline was set
+                    continue
+            self._lift(channel, mask)
+    
+    def _lift(self, channel, mask):
+        """Unban mask wherever we sit in channel, or hold it until we see
+        the channel's banlist"""
+        if channel == GLOBAL:
+            self._liftGlobal(mask)
+            return
+        present = False
+        for irc in world.ircs:
+            if channel not in irc.state.channels:
+                continue
+            present = True
+            chanstate = irc.state.channels[channel]
+            if mask in chanstate.bans and chanstate.isHalfopPlus(irc.nick):
+                self.queue.lift(irc, channel, mask)
+        if not present:
+            self._pendingLift.setdefault(channel, set()).add(mask)
+    
+    def _banLimit(self, irc, channel):
+        """Return how many bans we let channel hold, None if the server
+        advertises no limit"""
+        limit = irc.state.supported.get('maxlist', {}).get('b') or \
+            irc.state.supported.get('maxbans')
+        if not limit:
+            return None
+        return max(limit - self.registryValue('banSlotReserve', channel), 1)
+    
+    def _applyBan(self, irc, channel, mask):
+        """Queue +b mask in channel, lifting least recently used masks first
+        if the banlist has no free slot left"""
+        self._lastHit[(channel, mask)] = time.time()
+        bans = irc.state.channels[channel].bans
+        queued = self.queue.queued(irc, channel)
+        if mask not in bans and queued.get(mask) != '+b':
+            limit = self._banLimit(irc, channel)
+            if limit is not None:
+                used = len(bans) + 1
+                for (other, mode) in queued.items():
+                    used += (mode == '+b' and other not in bans) - (mode == '-b' and other in bans)
+                if used > limit:
+                    self._evict(irc, channel, used - limit)
+        self.queue.ban(irc, channel, mask)
+    
+    def _evict(self, irc, channel, count):
+        """Lift up to count of our masks from channel, least recently used
+        first, keeping them in the db; return how many were lifted"""
+        bans = irc.state.channels[channel].bans
+        queued = self.queue.queued(irc, channel)
+        with self.lock:
+            local = self.db.get(channel, {})
+            shared = self.db.get(GLOBAL, {})
+            masks = [mask for mask in bans if queued.get(mask) != '-b' and
+                     (mask in local or mask in shared)]
+            # Nothing is in _lastHit after a restart, the saved hit times
+            # still tell the masks apart
+            lastUsed = {mask: self._lastHit.get((channel, mask)) or
+                        self.hits.get(channel if mask in local else GLOBAL, {}).get(mask, (0, 0))[1]
+                        for mask in masks}
+        masks.sort(key=lastUsed.get)
+        for mask in masks[:count]:
+            self._unbanAt.pop((channel, mask), None)
+            self.queue.unban(irc, channel, mask)
+        if masks[:count]:
+            self.log.info(f'Blacklist: banlist of {channel} is full, lifted {len(masks[:count])} least recently used masks.')
+        return len(masks[:count])
+    
+    def _liftGlobal(self, mask, manual=False):
+        """Unban a network mask from every channel that does not list it
+        itself; as a low priority lift unless it was removed by hand"""
+        for irc in world.ircs:
+            for (channel, chanstate) in irc.state.channels.items():
+                with self.lock:
+                    if mask in self.db.get(channel, {}):
+                        continue
+                    self._unbanAt.pop((channel, mask), None)
+                if mask in chanstate.bans and chanstate.isHalfopPlus(irc.nick):
+                    if manual:
+                        self.queue.unban(irc, channel, mask)
+                    else:
+                        self.queue.lift(irc, channel, mask)
+    
+    def _scopes(self, channel):
+        """Return the banlists a join to channel is checked against, most
+        specific first"""
+        scopes = [channel] if channel in self.db else []
+        if GLOBAL in self.db and self.registryValue('useNetworkList', channel):
+            scopes.append(GLOBAL)
+        return scopes
+    
+    def _match(self, channel, hostmask, account=None):
+        """Return (scope, mask) of the first entry matching hostmask (or the
+        services account) in the merged view of channel's banlists, or
+        None"""
+        with self.lock:
+            scopes = self._scopes(channel)
+            if not scopes:
+                return None
+            generation = tuple(self.generation.get(scope, 0) for scope in scopes)
+            if self.misses.hit(channel, hostmask, generation, account):
+                self.perf.incr('joinCacheHits')
+                return None
+            comparisons = 0
+            found = None
+            for scope in scopes:
+                index = self._index(scope)
+                if index is None:
+                    continue
+                mask = index.match(hostmask, account)
+                comparisons += index.comparisons
+                if mask is not None:
+                    found = (scope, mask)
+                    break
+            else:
+                self.misses.add(channel, hostmask, generation, account)
+        self.perf.observe('comparisons', comparisons)
+        return found
     
     def _elapsed(self, inp):
         lapsed = int(time.time()-inp)
@@ -66,48 +471,97 @@ class Blacklist(callbacks.Plugin):
     
     def _createMask(self, irc, target, num):
         nick, ident, host = ircutils.splitHostmask(irc.state.nickToHostmask(target))
+        template = self.banmasks[num]
+        if "." not in host:
+            # Nothing to widen to (e.g. a cloak), ban the host itself
+            template = template.replace("*.phost", "host")
         mask = re.sub(
             "(nick|ident|host|phost)",
             lambda match: {
                 "nick": nick,
                 "ident": ident,
                 "host": host,
-                "phost": host.split(".")[1]
-                if "." in host
-                else mask.split("@")[0] + f"@{host}",
+                "phost": host.split(".", 1)[-1],
             }[match.group(1)],
-            self.banmasks[num],
+            template,
         )
         return mask
     
-    def _sendToPaste(self, content):
-        """Send content to termbin.com and return URL"""
-        try:
-            import socket
-            
-            # termbin.com uses netcat protocol on port 9999
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(10)
-            sock.connect(('termbin.com', 9999))
-            sock.sendall(content.encode('utf-8'))
-            sock.shutdown(socket.SHUT_WR)
-            
-            # Receive the URL
-            url = b''
-            while True:
-                data = sock.recv(1024)
-                if not data:
-                    break
-                url += data
-            sock.close()
-            
-            # Strip null bytes and whitespace
-            return url.decode('utf-8').rstrip('\x00\n\r ')
-        except Exception as e:
-            self.log.error(f'Failed to send to termbin.com: {e}')
-            return None
+    def _pasteTarget(self):
+        """Return where pasteService uploads to, None for 'http' without a
+        pasteTarget since it has no default"""
+        service = self.registryValue('pasteService')
+        target = self.registryValue('pasteTarget')
+        if target:
+            return target
+        if service == 'file':
+            return os.path.join(os.path.dirname(self.dbfile), 'pastes')
+        if service == 'termbin':
+            return 'termbin.com:9999'
+        return None
+    
+    def _channelHosts(self, irc, channel):
+        key = (irc.network, channel)
+        if key not in self.hosts:
+            hostmasks = []
+            for nick in irc.state.channels[channel].users:
+                try: hostmasks.append(irc.state.nickToHostmask(nick))
+                except KeyError: pass
+            self.hosts[key] = ChannelHosts(hostmasks, self.fold)
+        return self.hosts[key]
+    
+    def _networkHosts(self, irc, nick):
+        """Yield the caches of every channel nick is known in on irc"""
+        for (network, channel), hosts in self.hosts.items():
+            if network == irc.network and nick in hosts:
+                yield hosts
+    
+    def doPart(self, irc, msg):
+        for channel in msg.args[0].split(','):
+            if ircutils.strEqual(msg.nick, irc.nick):
+                self.hosts.pop((irc.network, channel), None)
+                self._banlists.discard((irc.network, channel))
+            elif (irc.network, channel) in self.hosts:
+                self.hosts[(irc.network, channel)].discard(msg.nick)
+    
+    def doKick(self, irc, msg):
+        channel = msg.args[0]
+        if ircutils.strEqual(msg.args[1], irc.nick):
+            self.hosts.pop((irc.network, channel), None)
+            self._banlists.discard((irc.network, channel))
+        elif (irc.network, channel) in self.hosts:
+            self.hosts[(irc.network, channel)].discard(msg.args[1])
+    
+    def doQuit(self, irc, msg):
+        for hosts in list(self._networkHosts(irc, msg.nick)):
+            hosts.discard(msg.nick)
+    
+    def doNick(self, irc, msg):
+        (nick, ident, host) = ircutils.splitHostmask(msg.prefix)
+        hostmask = ircutils.joinHostmask(msg.args[0], ident, host)
+        for hosts in list(self._networkHosts(irc, msg.nick)):
+            hosts.rename(msg.nick, hostmask)
+        self._recheck(irc, msg.args[0], hostmask,
+                      irc.state.nicksToAccounts.get(msg.args[0]))
+    
+    def doChghost(self, irc, msg):
+        hostmask = ircutils.joinHostmask(msg.nick, msg.args[0], msg.args[1])
+        for hosts in self._networkHosts(irc, msg.nick):
+            hosts.set(hostmask)
+        self._recheck(irc, msg.nick, hostmask,
+                      irc.state.nicksToAccounts.get(msg.nick))
+    
+    def do315(self, irc, msg):
+        # End of WHO: the state now knows everyone's hostmask, reseed lazily
+        self.hosts.pop((irc.network, msg.args[1]), None)
     
     def doMode(self, irc, msg):
+        if not ircutils.strEqual(msg.nick, irc.nick):
+            for (mode, mask) in ircutils.separateModes(msg.args[1:]):
+                if mode == '-b':
+                    # Removed by hand, there is nothing left for us to lift
+                    with self.lock:
+                        self._unbanAt.pop((msg.args[0], mask), None)
         if msg.args[1:] and msg.args[1] == '+b' and \
           not ircutils.hostmaskPatternEqual(msg.prefix, irc.prefix) and \
           self.registryValue('addManualBans', msg.args[0]) and \
@@ -117,8 +571,9 @@ class Blacklist(callbacks.Plugin):
             channel = msg.args[0]
             mask = msg.args[2]
             
-            # STOP! Don't track extbans (anything starting with ~)
-            if mask.startswith('~'):
+            # STOP! Don't track extbans (anything starting with ~) other
+            # than account bans
+            if mask.startswith('~') and accountName(mask) is None:
                 self.log.info(f'Ignoring extban in {channel}: {mask}')
                 return
             
@@ -131,38 +586,150 @@ class Blacklist(callbacks.Plugin):
             
             # Calculate expiry for manually added bans (use banlistExpiry setting)
             expiry_time = int(time.time()) + (self.registryValue('banlistExpiry', channel) * 60)
-            try: self.db[channel][mask] = [msg.nick, time.time(), '*user-added ban', expiry_time, False]
-            except KeyError: self.db[channel] = {mask: [msg.nick, time.time(), '*user-added ban', expiry_time, False]}
+            self._dbSet(channel, mask, [msg.nick, time.time(), '*user-added ban', expiry_time, False])
             self._dbWrite()
             irc.reply(f'"{mask}" added to the banlist for {channel}.')
             
             # Schedule automatic removal from channel (keep in database like normal bans)
-            def _normalExpiry():
-                # Only remove from channel, keep in database
-                irc.queueMsg(ircmsgs.unban(channel, mask))
-            
-            schedule.addEvent(_normalExpiry,
-                              time.time()+(self.registryValue('banlistExpiry', channel)*60),
-                              f'bl_unban_{channel}{mask}')
+            self._scheduleLift(channel, mask, expiry_time)
+    
+    def do368(self, irc, msg):
+        # End of banlist: the channel's +b list is now known in full
+        channel = msg.args[1]
+        if channel not in irc.state.channels:
+            return
+        self._banlists.add((irc.network, channel))
+        self._reconcile(irc, channel)
+    
+    def _reconcile(self, irc, channel):
+        """Bring channel's +b list in line with the db and return
+        (unbanned, deadlines restored, deadlines dropped).
+
+        Bans whose lift came due while we were away are removed, bans we
+        track but hold no deadline for (e.g. network masks after a
+        restart) get one, and deadlines of masks ops removed by hand are
+        forgotten.  Only the unbans cause MODE lines, sent as low priority lifts."""
+        chanstate = irc.state.channels[channel]
+        if not chanstate.isHalfopPlus(irc.nick):
+            return (0, 0, 0)
+        now = time.time()
+        when = now + self.registryValue('banlistExpiry', channel)*60
+        queued = self.queue.queued(irc, channel)
+        useNetwork = self.registryValue('useNetworkList', channel)
+        unban = []
+        adopt = []
+        dropped = 0
+        with self.lock:
+            overdue = self._pendingLift.pop(channel, set())
+            local = self.db.get(channel, {})
+            shared = self.db.get(GLOBAL, {}) if useNetwork else {}
+            for mask in chanstate.bans:
+                if mask in queued:
+                    continue
+                deadline = self._unbanAt.get((channel, mask))
+                if mask in overdue or (deadline is not None and deadline <= now):
+                    unban.append(mask)
+                elif deadline is None and mask in local:
+                    adopt.append((mask, channel))
+                elif deadline is None and mask in shared:
+                    adopt.append((mask, GLOBAL))
+            for key in [key for key in self._unbanAt if key[0] == channel]:
+                if key[1] not in chanstate.bans and queued.get(key[1]) != '+b':
+                    del self._unbanAt[key]
+                    dropped += 1
+        for mask in unban:
+            self._unbanAt.pop((channel, mask), None)
+            self.queue.lift(irc, channel, mask)
+        for (mask, scope) in adopt:
+            self._scheduleLift(channel, mask, when, scope)
+        return (len(unban), len(adopt), dropped)
+    
+    def do478(self, irc, msg):
+        # ERR_BANLISTFULL: make room and try again, unless nothing of ours
+        # is left to make room with
+        (channel, mask) = msg.args[1:3]
+        if channel not in irc.state.channels:
+            return
+        with self.lock:
+            self._unbanAt.pop((channel, mask), None)
+            tracked = mask in self.db.get(channel, {}) or mask in self.db.get(GLOBAL, {})
+        if not tracked:
+            return
+        if self._evict(irc, channel, 1):
+            self.queue.ban(irc, channel, mask)
+        else:
+            self.log.warning(f'Blacklist: banlist of {channel} is full, could not set {mask}.')
     
     def doJoin(self, irc, msg):
+        for channel in msg.args[0].split(','):
+            if ircutils.strEqual(msg.nick, irc.nick):
+                self.hosts.pop((irc.network, channel), None)
+                self._banlists.discard((irc.network, channel))
+            elif (irc.network, channel) in self.hosts:
+                self.hosts[(irc.network, channel)].set(msg.prefix)
         if self.registryValue('enabled', msg.args[0]) and \
           irc.state.channels[msg.args[0]].isHalfopPlus(irc.nick) and \
-          not ircutils.strEqual(msg.nick, irc.nick) and msg.args[0] in self.db:
-            for mask in self.db[msg.args[0]]:
-                if ircutils.hostmaskPatternEqual(mask, msg.prefix):
-                    irc.queueMsg(ircmsgs.ban(msg.args[0], mask))
-                    irc.queueMsg(ircmsgs.kick(msg.args[0], msg.nick, self.db[msg.args[0]][mask][2]))
-                    schedule.addEvent(lambda: irc.queueMsg(ircmsgs.unban(msg.args[0], mask)),
-                                      time.time()+(self.registryValue('banlistExpiry', msg.args[0])*60),
-                                      f'bl_unban_{msg.args[0]}{mask}')
-                    break
+          not ircutils.strEqual(msg.nick, irc.nick):
+            channel = msg.args[0]
+            start = time.perf_counter()
+            # Limnoria has already taken the account from extended-join
+            found = self._match(channel, msg.prefix,
+                                irc.state.nicksToAccounts.get(msg.nick))
+            self.perf.incr('joins')
+            self.perf.elapsed('joinCheck', start)
+            if found is not None:
+                self.perf.incr('joinMatches')
+                self._enforce(irc, channel, msg.nick, *found)
+    
+    def _enforce(self, irc, channel, nick, scope, mask):
+        """Ban mask and kick nick, who matched it, from channel"""
+        self._recordHit(scope, mask)
+        self._applyBan(irc, channel, mask)
+        self.queue.kick(irc, channel, nick, self.db[scope][mask][2])
+        self._scheduleLift(channel, mask,
+                           time.time()+(self.registryValue('banlistExpiry', channel)*60),
+                           scope)
+    
+    def doAccount(self, irc, msg):
+        # account-notify: someone logged in, check the account against the
+        # channels we share
+        if msg.args[0] == '*':
+            return
+        self._recheck(irc, msg.nick, msg.prefix, msg.args[0])
+    
+    def _recheck(self, irc, nick, hostmask, account):
+        """Check someone already in our channels whose nick, host or
+        account just changed, as if they had joined again"""
+        if ircutils.strEqual(nick, irc.nick):
+            return
+        for (channel, chanstate) in irc.state.channels.items():
+            if nick not in chanstate.users or \
+              not self.registryValue('enabled', channel) or \
+              not chanstate.isHalfopPlus(irc.nick):
+                continue
+            start = time.perf_counter()
+            found = self._match(channel, hostmask, account)
+            self.perf.incr('rechecks')
+            self.perf.elapsed('recheck', start)
+            if found is not None:
+                self.perf.incr('recheckMatches')
+                self._enforce(irc, channel, nick, *found)
+    
+    def _matchingNicks(self, irc, channel, mask):
+        """Return the nicks in channel mask applies to"""
+        account = accountName(mask)
+        if account is None:
+            return self._channelHosts(irc, channel).match(mask)
+        return [nick for nick in irc.state.channels[channel].users
+                if ircutils.toLower(irc.state.nicksToAccounts.get(nick) or '') == account]
     
     def add(self, irc, msg, args, channel, target, reason):
         """[<channel>] <nick|mask> [<reason>]
         
-        Add <nick|hostmask> to blacklist database (requires #channel,op capability)"""
+        Add <nick|hostmask> to blacklist database, account bans ($a:account, ~a:account) are matched against services accounts (requires #channel,op capability)"""
+        start = time.perf_counter()
         self._ban(irc, msg, args, channel, target, None, reason)
+        self.perf.elapsed('ban', start)
     add = wrap(add, [('checkChannelCapability', 'op'), 'channel',
                      'somethingWithoutSpaces', optional('text')])
     
@@ -171,7 +738,9 @@ class Blacklist(callbacks.Plugin):
         
         Add <nick|hostmask> to blacklist database, expiry is given in minutes (requires #channel,op capability)"""
         if not timer: timer = self.registryValue('banTimerExpiry', channel)
+        start = time.perf_counter()
         self._ban(irc, msg, args, channel, target, timer, reason)
+        self.perf.elapsed('ban', start)
     timer = wrap(timer, [('checkChannelCapability', 'op'), 'channel',
                          'somethingWithoutSpaces', optional('PositiveInt'),
                          optional('text')])
@@ -186,13 +755,18 @@ class Blacklist(callbacks.Plugin):
         if channel not in irc.state.channels:
             irc.error(f'I\'m not in {channel}.')
             return
-        if ircutils.isUserHostmask(target):
-            if ircutils.hostmaskPatternEqual(target, irc.prefix):
+        if accountName(target) is not None:
+            if self._bansSelf(irc, target):
                 irc.error('You want me to blacklist myself?!')
                 return
-            # STOP! Don't allow extbans
+            mask = target
+        elif ircutils.isUserHostmask(target):
+            if self._bansSelf(irc, target):
+                irc.error('You want me to blacklist myself?!')
+                return
+            # STOP! Don't allow extbans other than account bans
             if target.startswith('~'):
-                irc.error('Extbans are not supported. Use traditional hostmasks only.')
+                irc.error('Extbans are not supported. Use hostmasks or account bans only.')
                 return
             mask = target
         elif irc.isNick(target):
@@ -219,39 +793,153 @@ class Blacklist(callbacks.Plugin):
         
         if channel not in self.db or mask not in self.db[channel]:
             # Store: [banner_nick, ban_timestamp, reason, expiry_timestamp, is_timed]
-            try: self.db[channel][mask] = [msg.nick, int(time.time()), reason, expiry_time, bool(timer)]
-            except KeyError: self.db[channel] = {mask: [msg.nick, int(time.time()), reason, expiry_time, bool(timer)]}
+            self._dbSet(channel, mask, [msg.nick, int(time.time()), reason, expiry_time, bool(timer)])
             self._dbWrite()
             irc.reply(f'"{mask}" added to the banlist for {channel}.')
-        irc.queueMsg(ircmsgs.ban(channel, mask))
-        for nick in irc.state.channels[channel].users:
-            if ircutils.hostmaskPatternEqual(mask, irc.state.nickToHostmask(nick)):
-                irc.queueMsg(ircmsgs.kick(channel, nick, reason))
+        self._applyBan(irc, channel, mask)
+        for nick in self._matchingNicks(irc, channel, mask):
+            self.queue.kick(irc, channel, nick, reason)
         
         if timer:
             # TIMED BAN: Remove from channel AND database when expired
-            def _timedExpiry():
-                # Remove from database
-                if channel in self.db and mask in self.db[channel]:
-                    del self.db[channel][mask]
-                    if len(self.db[channel]) == 0:
-                        del self.db[channel]
-                    self._dbWrite()
-                # Remove from channel
-                irc.queueMsg(ircmsgs.unban(channel, mask))
-            
-            schedule.addEvent(_timedExpiry,
-                              time.time()+(timer*60), 
-                              f'bl_timed_unban_{channel}{mask}')
+            self.expiries.push(expiry_time, channel, mask)
         else:
             # NORMAL BAN: Remove from channel but keep in database
-            def _normalExpiry():
-                # Only remove from channel, keep in database
-                irc.queueMsg(ircmsgs.unban(channel, mask))
-            
-            schedule.addEvent(_normalExpiry,
-                              time.time()+(self.registryValue('banlistExpiry', channel)*60),
-                              f'bl_unban_{channel}{mask}')
+            self._scheduleLift(channel, mask, expiry_time)
+    
+    def sync(self, irc, msg, args, channel):
+        """[<channel>]
+        
+        Reconcile the channel's banlist with the blacklist database, lifting overdue bans (requires #channel,op capability)"""
+        if channel not in irc.state.channels:
+            irc.error(f'I\'m not in {channel}.')
+            return
+        if not irc.state.channels[channel].isHalfopPlus(irc.nick):
+            irc.error(f'I have no powers in {channel}.')
+            return
+        if (irc.network, channel) not in self._banlists:
+            # Reconciled from do368 once the list is in
+            irc.reply(f'Fetching the banlist for {channel}, it will be reconciled when it arrives.')
+            irc.queueMsg(ircmsgs.mode(channel, ['+b']))
+            return
+        (unbanned, restored, dropped) = self._reconcile(irc, channel)
+        irc.reply(f'Banlist for {channel} reconciled: {unbanned} bans lifted, '
+                  f'{restored} lift times restored, {dropped} manual removals noted.')
+    sync = wrap(sync, [('checkChannelCapability', 'op'), 'channel'])
+    
+    def _metricsLine(self):
+        (modes, kicks) = self.queue.depth()
+        return ' | '.join([f'last {self._elapsed(self.perf.since)}'] +
+                          self.perf.report() +
+                          [f'queued: {modes} modes, {kicks} kicks'])
+    
+    def _logMetrics(self):
+        self.log.info(f'Blacklist metrics: {self._metricsLine()}')
+    
+    def metrics(self, irc, msg, args, optlist):
+        """[--reset]
+        
+        Shows join check, nick/host change recheck, ban and database write timings (in ms), patterns compared per join and moderation lines per flush; --reset starts counting afresh (requires admin capability)"""
+        irc.reply(self._metricsLine())
+        if ('reset', True) in optlist:
+            self.perf.reset()
+    metrics = wrap(metrics, ['admin', getopts({'reset': ''})])
+    
+    def stats(self, irc, msg, args, channel, count):
+        """[<channel>] [<count>]
+        
+        Shows the <count> masks that matched the most joins in <channel> and the masks that never matched one, oldest first (requires #channel,op capability)"""
+        self._stats(irc, channel, count or 5)
+    stats = wrap(stats, [('checkChannelCapability', 'op'), 'channel',
+                         optional('PositiveInt')])
+    
+    def _stats(self, irc, scope, count):
+        label = 'all channels' if scope == GLOBAL else scope
+        with self.lock:
+            entries = dict(self.db.get(scope, {}))
+            hits = {mask: list(h) for mask, h in self.hits.get(scope, {}).items()
+                    if mask in entries}
+        if not entries:
+            irc.reply(f'The banlist for {label} is currently empty.')
+            return
+        top = sorted(hits.items(), key=lambda item: (-item[1][0], -item[1][1]))[:count]
+        if top:
+            irc.reply(f'Top masks for {label}: ' + ', '.join(
+                f'{mask} ({n} hits, last {self._elapsed(last)} ago)' for mask, (n, last) in top))
+        else:
+            irc.reply(f'No mask for {label} has matched a join yet.')
+        dead = sorted((mask for mask in entries if mask not in hits),
+                      key=lambda mask: entries[mask][1])
+        if dead:
+            more = ' ...' if len(dead) > count else ''
+            irc.reply(f'{len(dead)} of {len(entries)} masks never matched: {", ".join(dead[:count])}{more}')
+    
+    def dedup(self, irc, msg, args, channel, optlist):
+        """[<channel>] [--apply]
+        
+        Finds masks in <channel>'s banlist that a broader mask lasting at least as long already covers; --apply merges them into it (requires #channel,op capability)"""
+        self._dedup(irc, channel, ('apply', True) in optlist)
+    dedup = wrap(dedup, [('checkChannelCapability', 'op'), 'channel',
+                         getopts({'apply': ''})])
+    
+    def _dedup(self, irc, scope, apply):
+        """Report, or with apply merge, the masks of scope covered by a
+        broader one"""
+        label = 'all channels' if scope == GLOBAL else scope
+        with self.lock:
+            entries = {mask: list(v) for mask, v in self.db.get(scope, {}).items()}
+        merges = redundant(entries, self.fold)
+        if not merges:
+            irc.reply(f'No mask in the banlist for {label} is covered by another.')
+            return
+        # Masks outside the wildcard bucket only cost a comparison on the
+        # joins that reach their bucket
+        index = MaskIndex(merges, self.fold)
+        everyJoin = len(index.wild)
+        with self.lock:
+            held = [(net, channel, mask) for net in world.ircs
+                    for (channel, chanstate) in net.state.channels.items()
+                    if chanstate.isHalfopPlus(net.nick) and
+                    (channel == scope or (scope == GLOBAL and
+                                          self.registryValue('useNetworkList', channel)))
+                    for mask in merges if mask in chanstate.bans and
+                    (channel == scope or mask not in self.db.get(channel, {}))]
+        examples = ', '.join(f'{mask} (by {keeper})' for mask, keeper in sorted(merges.items())[:5])
+        more = ' ...' if len(merges) > 5 else ''
+        summary = (f'{len(merges)} of {len(entries)} masks in the banlist for {label} are covered '
+                   f'by broader ones: {examples}{more} | {everyJoin} of them are tried on every '
+                   f'join, {len(held)} hold a ban slot')
+        if not apply:
+            irc.reply(f'{summary}. Use --apply to merge them.')
+            return
+        with self.lock:
+            for (mask, keeper) in merges.items():
+                if mask not in self.db.get(scope, {}) or keeper not in self.db.get(scope, {}):
+                    # Changed since the analysis
+                    continue
+                v = list(self.db[scope][keeper])
+                v[1] = min(v[1], self.db[scope][mask][1])
+                self._dbSet(scope, keeper, v)
+                hit = self.hits.get(scope, {}).get(mask)
+                if hit is not None:
+                    mine = self.hits[scope].setdefault(keeper, [0, 0])
+                    mine[0] += hit[0]
+                    mine[1] = max(mine[1], hit[1])
+                self._dbDel(scope, mask)
+        self._dbWrite()
+        self.hitWriter.markDirty()
+        for (net, channel, mask) in held:
+            # Swap the lifted mask for its keeper so nobody it held gets back in
+            self._unbanAt.pop((channel, mask), None)
+            self.queue.unban(net, channel, mask)
+            keeper = merges[mask]
+            if keeper not in net.state.channels[channel].bans and \
+              self.queue.queued(net, channel).get(keeper) != '+b':
+                self._applyBan(net, channel, keeper)
+                self._scheduleLift(channel, keeper,
+                                   time.time()+(self.registryValue('banlistExpiry', channel)*60),
+                                   scope)
+        irc.reply(f'Merged: {summary}.')
     
     def remove(self, irc, msg, args, channel, mask):
         """[<channel>] <mask>
@@ -263,15 +951,10 @@ class Blacklist(callbacks.Plugin):
         if channel not in self.db or mask not in self.db[channel]:
             irc.error(f'"{mask}" is not in my banlist for {channel}.')
             return
-        try:
-            schedule.removeEvent(f'bl_unban_{channel}{mask}')
-            schedule.removeEvent(f'bl_timed_unban_{channel}{mask}')
-        except: pass
+        self._unbanAt.pop((channel, mask), None)
         if mask in irc.state.channels[channel].bans:
-            irc.queueMsg(ircmsgs.unban(channel, mask))
-        del self.db[channel][mask]
-        if len(self.db[channel]) == 0:
-            del self.db[channel]
+            self.queue.unban(irc, channel, mask)
+        self._dbDel(channel, mask)
         self._dbWrite()
         irc.reply(f'"{mask}" removed from the banlist in {channel}.')
     remove = wrap(remove, [('checkChannelCapability', 'op'), 'channel', 'text'])
@@ -280,20 +963,41 @@ class Blacklist(callbacks.Plugin):
         """[<channel>]
         
         Returns a list of banmasks stored in <channel> (requires #channel,op capability)"""
-        if channel not in self.db:
-            irc.reply(f'The banlist for {channel} is currently empty.')
+        self._list(irc, channel)
+    list = wrap(list, [('checkChannelCapability', 'op'), 'channel'])
+    
+    def _list(self, irc, scope):
+        """Reply with the banlist of scope, a channel or GLOBAL"""
+        channel = None if scope == GLOBAL else scope
+        label = 'all channels' if scope == GLOBAL else scope
+        with self.lock:
+            entries = dict(self.db.get(scope, {}))
+            revision = self.revision.get(scope, 0)
+        if not entries:
+            irc.reply(f'The banlist for {label} is currently empty.')
             return
         
         # Get the max entries to display directly in channel
         max_output = self.registryValue('maxListOutput', channel)
+        paste = max_output == 0 or len(entries) > max_output
+        
+        # Reuse the last paste while the banlist is unchanged
+        target = self._pasteTarget()
+        if paste and target is None:
+            irc.error('pasteTarget must be set to the URL to post to when pasteService is http.')
+            return
+        key = (revision, self.registryValue('pasteService'), target)
+        if paste and scope in self.pastes and self.pastes[scope][0] == key:
+            irc.reply(f'Banlist for {label} ({len(entries)} entries): {self.pastes[scope][1]}')
+            return
         
         # Build the output
         lines = []
-        lines.append(f'Banlist for {channel} ({len(self.db[channel])} entries)')
+        lines.append(f'Banlist for {label} ({len(entries)} entries)')
         lines.append('=' * 80)
         
-        padwidth = len(max((mask for mask in self.db[channel]), key=len))
-        for banmask, v in self.db[channel].items():
+        padwidth = len(max((mask for mask in entries), key=len))
+        for banmask, v in entries.items():
             elapsed = self._elapsed(v[1])
             
             # Handle both old format [nick, timestamp, reason] and new format [nick, timestamp, reason, expiry, is_timed]
@@ -311,18 +1015,252 @@ class Blacklist(callbacks.Plugin):
         content = '\n'.join(lines)
         
         # If maxListOutput is 0 or list exceeds threshold, send to paste service
-        if max_output == 0 or len(self.db[channel]) > max_output:
-            paste_url = self._sendToPaste(content)
-            if paste_url:
-                irc.reply(f'Banlist for {channel} ({len(self.db[channel])} entries): {paste_url}')
-            else:
-                irc.error('Failed to upload banlist to paste service. Check logs for details.')
+        if paste:
+            def _pasted(paste_url):
+                if paste_url:
+                    self.pastes[scope] = (key, paste_url)
+                    irc.reply(f'Banlist for {label} ({len(entries)} entries): {paste_url}')
+                else:
+                    irc.error('Failed to upload banlist to paste service. Check logs for details.')
+            self.paster.upload((scope,) + key, key[1], key[2], content, _pasted)
         else:
-            # Send directly to channel
+            # Send directly to the caller
             for line in lines[2:]:  # Skip header lines for direct output
                 irc.reply(line)
     
-    list = wrap(list, [('checkChannelCapability', 'op'), 'channel'])
+    def _maskError(self, irc, mask, checkSelf=True):
+        """Return why mask cannot go in a banlist, None if it can.
+        checkSelf=False leaves out whether it would ban the bot, which
+        costs compiling the mask."""
+        account = accountName(mask)
+        if account is None and not ircutils.isUserHostmask(mask):
+            return 'Invalid banmask.'
+        if checkSelf and self._bansSelf(irc, mask):
+            return 'You want me to blacklist myself?!'
+        # STOP! Don't allow extbans other than account bans
+        if mask.startswith('~') and account is None:
+            return 'Extbans are not supported. Use hostmasks or account bans only.'
+        return None
+    
+    def _bansSelf(self, irc, mask):
+        """Return whether mask would ban the bot, through its hostmask
+        (ranges and folded nicks included) or its services account"""
+        return MaskIndex([mask], self.fold).match(
+            irc.prefix, irc.state.nicksToAccounts.get(irc.nick)) is not None
+    
+    def _globalBan(self, irc, msg, mask, timer, reason):
+        error = self._maskError(irc, mask)
+        if error:
+            irc.error(error)
+            return
+        if mask in self.db.get(GLOBAL, {}):
+            irc.error(f'"{mask}" is already in the network banlist.')
+            return
+        if not reason:
+            reason = self.registryValue('banReason')
+        if timer:
+            expiry_time = int(time.time()) + (timer * 60)
+        else:
+            expiry_time = int(time.time()) + (self.registryValue('banlistExpiry') * 60)
+        self._dbSet(GLOBAL, mask, [msg.nick, int(time.time()), reason, expiry_time, bool(timer)])
+        self._dbWrite()
+        irc.reply(f'"{mask}" added to the network banlist.')
+        if timer:
+            self.expiries.push(expiry_time, GLOBAL, mask)
+        # Only channels where someone matches get the ban right away, the
+        # others pick it up when a matching user joins
+        for other in world.ircs:
+            for channel in other.state.channels:
+                if not self.registryValue('enabled', channel) or \
+                  not self.registryValue('useNetworkList', channel) or \
+                  not other.state.channels[channel].isHalfopPlus(other.nick):
+                    continue
+                nicks = self._matchingNicks(other, channel, mask)
+                if not nicks:
+                    continue
+                self._applyBan(other, channel, mask)
+                for nick in nicks:
+                    self.queue.kick(other, channel, nick, reason)
+                self._scheduleLift(channel, mask,
+                                   time.time()+(self.registryValue('banlistExpiry', channel)*60),
+                                   GLOBAL)
+    
+    def _dataPath(self, filename, subdir=''):
+        """Return filename resolved inside the plugin's data directory, or
+        its subdir if given, None if it points outside of it"""
+        base = os.path.normpath(os.path.join(os.path.dirname(self.dbfile), subdir))
+        path = os.path.normpath(os.path.join(base, filename))
+        if os.path.isabs(filename) or not path.startswith(base + os.sep):
+            return None
+        return path
+    
+    def _import(self, irc, msg, scope, fmt, filename):
+        """Stream the bans of a file into scope with one batched write"""
+        label = 'all channels' if scope == GLOBAL else scope
+        path = self._dataPath(filename)
+        if path is None:
+            irc.error(f'Files are read from {os.path.dirname(self.dbfile)} only.')
+            return
+        start = time.perf_counter()
+        now = int(time.time())
+        entries = {}
+        skipped = 0
+        bad = 0
+        try:
+            with open(path, 'r') as f:
+                fmt = fmt or detect(f)
+                with self.lock:
+                    listed = set(self.db.get(scope, {}))
+                lift = now + self.registryValue('banlistExpiry', None if scope == GLOBAL else scope) * 60
+                for (mask, entry) in readBans(f, fmt, msg.nick, self.registryValue('banReason'), now, lift):
+                    if not validEntry(entry) or self._maskError(irc, mask, checkSelf=False):
+                        bad += 1
+                    elif mask in listed or mask in entries:
+                        skipped += 1
+                    else:
+                        entries[mask] = entry
+        except (IOError, ValueError) as e:
+            irc.error(f'Could not import {filename}: {e}')
+            return
+        if entries:
+            self._dbBulk(scope, entries)
+            # The rebuilt index narrows the check for masks that would ban
+            # the bot itself down to its candidates for our own hostmask
+            prefix = self.fold(irc.prefix) if self.fold else irc.prefix
+            account = ircutils.toLower(irc.state.nicksToAccounts.get(irc.nick) or '')
+            with self.lock:
+                mine = {mask for (mask, matcher) in self._index(scope).candidates(prefix)
+                        if mask in entries and matcher(prefix) is not None}
+                mine.update(mask for mask in entries
+                            if account and accountName(mask) == account)
+                for mask in mine:
+                    self._dbDel(scope, mask)
+                    del entries[mask]
+            if mine:
+                self._dbWrite()
+            bad += len(mine)
+            self.expiries.extend((v[3], scope, mask) for mask, v in entries.items()
+                                 if len(v) >= 5 and v[4])
+        self.perf.elapsed('import', start)
+        irc.reply(f'Imported {len(entries)} masks ({fmt}) into the banlist for {label} in '
+                  f'{time.perf_counter() - start:.2f}s; {skipped} were already listed, '
+                  f'{bad} were unusable.')
+    
+    def _export(self, irc, scope, fmt, filename):
+        """Write the banlist of scope to a file in the exports directory,
+        apart from the files the plugin keeps its own data in"""
+        label = 'all channels' if scope == GLOBAL else scope
+        path = self._dataPath(filename, 'exports')
+        if path is None:
+            irc.error(f'Files are written to {os.path.join(os.path.dirname(self.dbfile), "exports")} only.')
+            return
+        with self.lock:
+            entries = {mask: list(v) for mask, v in self.db.get(scope, {}).items()}
+        if not entries:
+            irc.reply(f'The banlist for {label} is currently empty.')
+            return
+        fmt = fmt or 'json'
+        tmp = path + '.tmp'
+        try:
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(tmp, 'w') as f:
+                writeBans(f, fmt, scope, entries, f'{irc.network}/{label}')
+            os.replace(tmp, path)
+        except IOError as e:
+            irc.error(f'Could not export to {filename}: {e}')
+            return
+        irc.reply(f'Exported {len(entries)} masks ({fmt}) from the banlist for {label} to {path}')
+    
+    def export(self, irc, msg, args, channel, optlist, filename):
+        """[<channel>] [--format json|autoban|text] <file>
+        
+        Writes the banlist of <channel> to <file> in the exports directory of the plugin's data directory, as the plugin's own JSON (default), a WeeChat autoban.json or one mask and reason per line (requires admin capability)"""
+        self._export(irc, channel, dict(optlist).get('format'), filename)
+    export = wrap(export, ['admin', 'channel', getopts({'format': ('literal', FORMATS)}),
+                           'text'])
+    
+    class network(callbacks.Commands):
+        """Manage the banlist shared by every channel with useNetworkList
+        enabled (requires admin capability)"""
+        
+        def add(self, irc, msg, args, mask, reason):
+            """<mask> [<reason>]
+            
+            Add <mask> to the network blacklist, it is enforced in every channel with useNetworkList enabled"""
+            plugin = irc.getCallback('Blacklist')
+            plugin._globalBan(irc, msg, mask, None, reason)
+        add = wrap(add, ['admin', 'somethingWithoutSpaces', optional('text')])
+        
+        def timer(self, irc, msg, args, mask, timer, reason):
+            """<mask> [<expiry>] [<reason>]
+            
+            Add <mask> to the network blacklist, expiry is given in minutes"""
+            plugin = irc.getCallback('Blacklist')
+            if not timer: timer = plugin.registryValue('banTimerExpiry')
+            plugin._globalBan(irc, msg, mask, timer, reason)
+        timer = wrap(timer, ['admin', 'somethingWithoutSpaces',
+                             optional('PositiveInt'), optional('text')])
+        
+        def remove(self, irc, msg, args, mask):
+            """<mask>
+            
+            Remove <mask> from the network blacklist and unban it wherever it was applied"""
+            plugin = irc.getCallback('Blacklist')
+            if mask not in plugin.db.get(GLOBAL, {}):
+                irc.error(f'"{mask}" is not in the network banlist.')
+                return
+            plugin._dbDel(GLOBAL, mask)
+            plugin._dbWrite()
+            plugin._liftGlobal(mask, manual=True)
+            irc.reply(f'"{mask}" removed from the network banlist.')
+        remove = wrap(remove, ['admin', 'text'])
+        
+        def dedup(self, irc, msg, args, optlist):
+            """[--apply]
+            
+            Finds network masks that a broader network mask lasting at least as long already covers; --apply merges them into it"""
+            irc.getCallback('Blacklist')._dedup(irc, GLOBAL, ('apply', True) in optlist)
+        dedup = wrap(dedup, ['admin', getopts({'apply': ''})])
+        
+        def stats(self, irc, msg, args, count):
+            """[<count>]
+            
+            Shows the <count> network masks that matched the most joins and the masks that never matched one"""
+            irc.getCallback('Blacklist')._stats(irc, GLOBAL, count or 5)
+        stats = wrap(stats, ['admin', optional('PositiveInt')])
+        
+        def export(self, irc, msg, args, optlist, filename):
+            """[--format json|autoban|text] <file>
+            
+            Writes the network banlist to <file> in the exports directory of the plugin's data directory"""
+            irc.getCallback('Blacklist')._export(irc, GLOBAL, dict(optlist).get('format'), filename)
+        export = wrap(export, ['admin', getopts({'format': ('literal', FORMATS)}), 'text'])
+        
+        def list(self, irc, msg, args):
+            """takes no arguments
+            
+            Returns the list of network-wide blacklisted banmasks"""
+            irc.getCallback('Blacklist')._list(irc, GLOBAL)
+        list = wrap(list, ['admin'])
+
+def _importCommand(self, irc, msg, args, channel, optlist, filename):
+    """[<channel>] [--format json|autoban|text] <file>
+    
+    Adds the bans in <file>, read from the plugin's data directory, to the banlist of <channel> in one go; the format is guessed when not given. Masks already listed are left alone (requires admin capability)"""
+    self._import(irc, msg, channel, dict(optlist).get('format'), filename)
+
+def _networkImportCommand(self, irc, msg, args, optlist, filename):
+    """[--format json|autoban|text] <file>
+    
+    Adds the bans in <file>, read from the plugin's data directory, to the network banlist in one go"""
+    irc.getCallback('Blacklist')._import(irc, msg, GLOBAL, dict(optlist).get('format'), filename)
+
+# 'import' is a keyword, so these commands can only be attached by name
+setattr(Blacklist, 'import', wrap(_importCommand, ['admin', 'channel',
+        getopts({'format': ('literal', FORMATS)}), 'text']))
+setattr(Blacklist.network, 'import', wrap(_networkImportCommand, ['admin',
+        getopts({'format': ('literal', FORMATS)}), 'text']))
 
 Class = Blacklist
 
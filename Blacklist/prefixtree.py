@@ -0,0 +1,97 @@
+###
+# Blacklist - prefixtree.py
+#
+# Address range bans (nick!ident@203.0.113.0/24, IPv6 prefixes alike).  The
+# ranges sit in a binary trie keyed on the network bits, so an IP host is
+# checked against every range with one walk down its own address.
+###
+
+import ipaddress
+
+
+def parseAddress(host):
+    """Return host as an ip_address, None if it is not an IP"""
+    if not host or not (host[0].isdigit() or ':' in host):
+        return None
+    try:
+        return ipaddress.ip_address(host)
+    except ValueError:
+        return None
+
+
+def parseRange(mask):
+    """Return (nick!ident pattern, ip_network) for a range mask, None if
+    mask is a plain hostmask"""
+    (user, sep, host) = mask.rpartition('@')
+    if not sep or '/' not in host or '!' not in user:
+        return None
+    try:
+        return (user, ipaddress.ip_network(host, strict=False))
+    except ValueError:
+        return None
+
+
+class PrefixTree(object):
+    """Binary trie of networks, one root per address family.  Nodes are
+    [zero child, one child, {mask: matcher}]."""
+
+    def __init__(self):
+        self.roots = {4: [None, None, {}], 6: [None, None, {}]}
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _bits(self, network):
+        bits = int(network.network_address)
+        width = network.max_prefixlen
+        return [(bits >> (width - 1 - i)) & 1 for i in range(network.prefixlen)]
+
+    def add(self, network, mask, matcher):
+        node = self.roots[network.version]
+        for bit in self._bits(network):
+            if node[bit] is None:
+                node[bit] = [None, None, {}]
+            node = node[bit]
+        if mask not in node[2]:
+            self.count += 1
+        node[2][mask] = matcher
+
+    def get(self, network, mask):
+        """Return the matcher stored for mask under network"""
+        node = self.roots[network.version]
+        for bit in self._bits(network):
+            node = node[bit]
+        return node[2][mask]
+
+    def discard(self, network, mask):
+        path = [self.roots[network.version]]
+        bits = self._bits(network)
+        for bit in bits:
+            if path[-1][bit] is None:
+                return
+            path.append(path[-1][bit])
+        if path[-1][2].pop(mask, None) is None:
+            return
+        self.count -= 1
+        # Prune the branch back up to the last node still in use
+        for (parent, bit) in zip(reversed(path[:-1]), reversed(bits)):
+            node = parent[bit]
+            if node[0] is not None or node[1] is not None or node[2]:
+                break
+            parent[bit] = None
+
+    def lookup(self, address):
+        """Yield (mask, matcher) for every range containing address,
+        widest first"""
+        node = self.roots[address.version]
+        bits = int(address)
+        width = address.max_prefixlen
+        yield from node[2].items()
+        for i in range(width):
+            node = node[(bits >> (width - 1 - i)) & 1]
+            if node is None:
+                return
+            yield from node[2].items()
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -0,0 +1,663 @@
+###
+# Blacklist - storage.py
+#
+# Persistence backends for the banlist database.  The plugin keeps the whole
+# db in memory; a store only decides how changes reach the disk.
+###
+
+import collections.abc, json, numbers, os, sqlite3, threading, time, urllib.parse, uuid
+
+from supybot import log
+
+
+def validEntry(v):
+    """Return whether v is a usable entry: [banner, ts, reason] with
+    optionally the expiry timestamp and the timed-ban flag"""
+    return isinstance(v, list) and 3 <= len(v) <= 5 and \
+        all(isinstance(x, str) for x in (v[0], v[2])) and \
+        all(isinstance(x, numbers.Real) for x in v[1:2] + v[3:4])
+
+
+def clean(db):
+    """Drop malformed channels and entries from db in place, and return
+    how many entries were dropped.  A ShardedDb is left alone, its shards
+    are cleaned as they are loaded."""
+    if isinstance(db, ShardedDb):
+        return 0
+    dropped = 0
+    for channel in list(db):
+        masks = db[channel]
+        if not isinstance(masks, dict):
+            del db[channel]
+            dropped += 1
+            continue
+        for mask in [mask for mask, v in masks.items() if not validEntry(v)]:
+            del masks[mask]
+            dropped += 1
+        if not masks:
+            del db[channel]
+    return dropped
+
+
+class JsonStore(object):
+    """Whole-database storage: every write re-serialises blacklist.json.
+
+    The snapshot being replaced is kept as blacklist.json.bak, and load()
+    falls back to it when blacklist.json is missing or unreadable."""
+
+    def __init__(self, path):
+        self.path = path
+        self.backup = path + '.bak'
+
+    def _mkdir(self):
+        if not os.path.exists(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+
+    def _dump(self, db):
+        """Write db to a temp file and rename it over blacklist.json"""
+        self._mkdir()
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(db, f)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(self.path):
+            os.replace(self.path, self.backup)
+        os.replace(tmp, self.path)
+
+    def _read(self, path):
+        with open(path, 'r') as f: db = json.load(f)
+        if not isinstance(db, dict):
+            raise ValueError('not a JSON object')
+        return db
+
+    def load(self):
+        """Return the db from the latest readable snapshot.  A snapshot that
+        fails to parse is kept as .corrupt for inspection; raises IOError
+        if there is no snapshot at all."""
+        try:
+            return self._read(self.path)
+        except FileNotFoundError:
+            if not os.path.exists(self.backup):
+                raise
+            log.warning(f'Blacklist: {self.path} is missing, loading the previous snapshot.')
+        except ValueError as e:
+            log.error(f'Blacklist: {self.path} is unreadable ({e}), loading the previous snapshot. '
+                      f'The bad file is kept as {self.path}.corrupt')
+            os.replace(self.path, self.path + '.corrupt')
+        try:
+            return self._read(self.backup)
+        except (IOError, ValueError) as e:
+            log.error(f'Blacklist: {self.backup} is unusable too ({e}), starting with an empty banlist.')
+            return {}
+
+    def record(self, channel, mask, entry):
+        """Note a change to one entry, entry is None for a removal"""
+        pass
+
+    def write(self, snapshot):
+        """Persist pending changes, snapshot() returns a copy of the db"""
+        self._dump(snapshot())
+
+    def compact(self, snapshot):
+        pass
+
+    def close(self):
+        pass
+
+
+class JournalStore(JsonStore):
+    """Snapshot in blacklist.json plus an append-only blacklist.journal.
+
+    Each change is appended to the journal as one JSON line
+    [channel, mask, entry] (entry is null for a removal), so a write costs
+    the size of the change.  compact() folds the journal into a new
+    snapshot; the journal is rotated to .old before the snapshot is taken,
+    so a crash at any point leaves snapshot + journals that still replay to
+    the right db."""
+
+    def __init__(self, path, maxRecords=0):
+        super().__init__(path)
+        self.journal = os.path.splitext(path)[0] + '.journal'
+        self.oldjournal = self.journal + '.old'
+        self.maxRecords = maxRecords
+        self.records = 0
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def _replay(self, db, path):
+        try:
+            f = open(path, 'r')
+        except IOError:
+            return 0
+        count = 0
+        with f:
+            for line in f:
+                count += 1
+                try:
+                    channel, mask, entry = json.loads(line)
+                    if entry is None:
+                        db.get(channel, {}).pop(mask, None)
+                        if channel in db and not db[channel]:
+                            del db[channel]
+                    else:
+                        db.setdefault(channel, {})[mask] = entry
+                except (ValueError, TypeError, AttributeError):
+                    # Torn write at the tail of the journal
+                    log.warning(f'Blacklist: skipping bad journal record in {path}')
+        return count
+
+    def load(self):
+        try:
+            db = super().load()
+        except IOError:
+            db = {}
+        self.records = self._replay(db, self.oldjournal)
+        self.records += self._replay(db, self.journal)
+        return db
+
+    def record(self, channel, mask, entry):
+        with self.lock:
+            self.pending.append(json.dumps([channel, mask, entry]) + '\n')
+
+    def write(self, snapshot):
+        with self.lock:
+            pending, self.pending = self.pending, []
+        if pending:
+            self._mkdir()
+            with open(self.journal, 'a') as f:
+                f.writelines(pending)
+                f.flush()
+                os.fsync(f.fileno())
+            self.records += len(pending)
+        if self.maxRecords and self.records >= self.maxRecords:
+            self.compact(snapshot)
+
+    def compact(self, snapshot):
+        """Fold the journal into a fresh snapshot"""
+        if not self.records:
+            return
+        self._rotate()
+        self.records = 0
+        self._dump(snapshot())
+        if os.path.exists(self.oldjournal):
+            os.remove(self.oldjournal)
+
+    def _rotate(self):
+        if not os.path.exists(self.journal):
+            return
+        if not os.path.exists(self.oldjournal):
+            os.replace(self.journal, self.oldjournal)
+            return
+        # A previous compaction never finished, keep its records too
+        with open(self.journal, 'r') as src, open(self.oldjournal, 'a') as dst:
+            dst.write(src.read())
+        os.remove(self.journal)
+
+
+class SqliteStore(object):
+    """Database in blacklist.sqlite3, in WAL mode so several bot processes
+    can share it.
+
+    Entries live in the bans table; every write also appends its changes
+    to the changes table, tagged with the writing process, so the others
+    pick them up with changes() by reading only the rows past the last
+    one they saw.  compact() prunes old change rows and remembers how far
+    it went, which tells a process that slept through the pruning to
+    reload instead."""
+
+    def __init__(self, path, keep=86400):
+        self.path = path
+        self.keep = keep
+        self.origin = uuid.uuid4().hex
+        self.pending = []
+        self.seen = 0
+        self.lock = threading.Lock()
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        # Used from the writer thread and the sync event, under self.lock
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS bans (channel TEXT, mask TEXT, entry TEXT,
+                                             PRIMARY KEY (channel, mask));
+            CREATE TABLE IF NOT EXISTS changes (seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                                                origin TEXT, ts REAL,
+                                                channel TEXT, mask TEXT, entry TEXT);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+        """)
+
+    def _meta(self, key, default=0):
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def _import(self):
+        """Seed an empty database from blacklist.json and its journal, if
+        there are any"""
+        jsonfile = os.path.splitext(self.path)[0] + '.json'
+        db = JournalStore(jsonfile).load()
+        if not db:
+            return
+        clean(db)
+        self.conn.executemany('INSERT OR IGNORE INTO bans VALUES (?, ?, ?)',
+                              [(channel, mask, json.dumps(v))
+                               for channel, masks in db.items() for mask, v in masks.items()])
+        log.info(f'Blacklist: imported {jsonfile} into {self.path}')
+
+    def load(self):
+        db = {}
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                if self.conn.execute('SELECT COUNT(*) FROM bans').fetchone()[0] == 0 and \
+                  not self._meta('imported'):
+                    self._import()
+                    self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('imported', 1)")
+                self.seen = self.conn.execute('SELECT COALESCE(MAX(seq), 0) FROM changes').fetchone()[0]
+                for (channel, mask, entry) in self.conn.execute('SELECT channel, mask, entry FROM bans'):
+                    try:
+                        db.setdefault(channel, {})[mask] = json.loads(entry)
+                    except ValueError:
+                        log.warning(f'Blacklist: skipping bad entry {channel} {mask} in {self.path}')
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+        return db
+
+    def record(self, channel, mask, entry):
+        with self.lock:
+            self.pending.append((channel, mask, None if entry is None else json.dumps(entry)))
+
+    def write(self, snapshot):
+        with self.lock:
+            pending, self.pending = self.pending, []
+            if not pending:
+                return
+            now = time.time()
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                for (channel, mask, entry) in pending:
+                    if entry is None:
+                        self.conn.execute('DELETE FROM bans WHERE channel = ? AND mask = ?',
+                                          (channel, mask))
+                    else:
+                        self.conn.execute('INSERT OR REPLACE INTO bans VALUES (?, ?, ?)',
+                                          (channel, mask, entry))
+                self.conn.executemany('INSERT INTO changes (origin, ts, channel, mask, entry) '
+                                      'VALUES (?, ?, ?, ?, ?)',
+                                      [(self.origin, now) + change for change in pending])
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                # Keep the changes for the next write
+                self.pending[:0] = pending
+                raise
+
+    def changes(self):
+        """Return [(channel, mask, entry)] written by other processes since
+        the last call, entry is None for a removal; None if some of them
+        were already pruned and the whole db has to be reloaded"""
+        with self.lock:
+            if self._meta('pruned') > self.seen:
+                return None
+            rows = self.conn.execute('SELECT seq, origin, channel, mask, entry FROM changes '
+                                     'WHERE seq > ? ORDER BY seq', (self.seen,)).fetchall()
+            changes = []
+            for (seq, origin, channel, mask, entry) in rows:
+                self.seen = seq
+                if origin == self.origin:
+                    continue
+                try:
+                    changes.append((channel, mask, None if entry is None else json.loads(entry)))
+                except ValueError:
+                    log.warning(f'Blacklist: skipping bad change {seq} in {self.path}')
+        return changes
+
+    def compact(self, snapshot):
+        """Drop change rows older than keep seconds and fold the WAL back
+        into the database file"""
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.conn.execute('SELECT MAX(seq) FROM changes WHERE ts < ?',
+                                        (time.time() - self.keep,)).fetchone()
+                if row[0] is not None:
+                    self.conn.execute('DELETE FROM changes WHERE seq <= ?', row)
+                    self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('pruned', ?)", row)
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class SqliteHitStore(object):
+    """Mask hit counters kept in the hits table of a SqliteStore's
+    database, for the hitWriter in 'sqlite' mode.
+
+    Every bot sharing the database adds the hits it counted since its last
+    write to the stored totals instead of writing out its own view, so no
+    bot overwrites another's counts.  The totals a bot shows include the
+    other bots' hits as of its last start."""
+
+    def __init__(self, db):
+        self.db = db
+        self.path = db.path
+        # (channel, mask) -> count as of the last load or write
+        self.written = {}
+        with db.lock:
+            db.conn.execute('CREATE TABLE IF NOT EXISTS hits (channel TEXT, mask TEXT, '
+                            'count INTEGER, last INTEGER, PRIMARY KEY (channel, mask))')
+
+    def load(self):
+        hits = {}
+        with self.db.lock:
+            rows = self.db.conn.execute('SELECT channel, mask, count, last FROM hits').fetchall()
+        for (channel, mask, count, last) in rows:
+            hits.setdefault(channel, {})[mask] = [count, last]
+            self.written[(channel, mask)] = count
+        return hits
+
+    def record(self, channel, mask, entry):
+        pass
+
+    def write(self, snapshot):
+        current = {(channel, mask): hit for channel, masks in snapshot().items()
+                   for mask, hit in masks.items()}
+        added = [(channel, mask, hit[0] - self.written.get((channel, mask), 0), hit[1])
+                 for (channel, mask), hit in current.items()
+                 if hit[0] != self.written.get((channel, mask), 0)]
+        # Counters of masks this bot removed from the banlist
+        gone = [key for key in self.written if key not in current]
+        if not added and not gone:
+            return
+        with self.db.lock:
+            self.db.conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.db.conn.executemany(
+                    'INSERT INTO hits VALUES (?, ?, MAX(?, 0), ?) ON CONFLICT (channel, mask) '
+                    'DO UPDATE SET count = MAX(count + excluded.count, 0), '
+                    'last = MAX(last, excluded.last)',
+                    [(channel, mask, n, last) for (channel, mask, n, last) in added])
+                self.db.conn.executemany('DELETE FROM hits WHERE channel = ? AND mask = ?', gone)
+                self.db.conn.execute('COMMIT')
+            except Exception:
+                self.db.conn.execute('ROLLBACK')
+                raise
+        for key in gone:
+            del self.written[key]
+        for (channel, mask, n, last) in added:
+            self.written[(channel, mask)] = current[(channel, mask)][0]
+
+    def compact(self, snapshot):
+        pass
+
+    def close(self):
+        pass
+
+
+class ShardedDb(collections.abc.MutableMapping):
+    """The db of ShardStore: a dict of channel -> {mask: entry} whose
+    channels are read from their shard the first time they are looked up.
+
+    Iteration only uses the names of the shards, so it loads nothing;
+    items() and values() load everything.  Membership reads the channel's
+    shard, which is its first use anyway: a shard that turns out empty or
+    unreadable drops its channel, so "in" and lookups always agree.
+    onLoad(channel, masks), if given, is called for every shard loaded."""
+
+    def __init__(self, load, scopes, stored, onLoad=None):
+        self._load = load
+        self.unloaded = set(scopes)
+        self.loaded = {}
+        # channel -> {mask: [expiry, timed]} of the unloaded shards
+        self.stored = stored
+        self.onLoad = onLoad
+        self.lock = threading.RLock()
+
+    def __getitem__(self, channel):
+        with self.lock:
+            try:
+                return self.loaded[channel]
+            except KeyError:
+                if channel not in self.unloaded:
+                    raise
+            masks = self._load(channel)
+            self.unloaded.discard(channel)
+            if not masks:
+                raise KeyError(channel)
+            self.loaded[channel] = masks
+        if self.onLoad is not None:
+            self.onLoad(channel, masks)
+        return masks
+
+    def __setitem__(self, channel, masks):
+        with self.lock:
+            self.unloaded.discard(channel)
+            self.loaded[channel] = masks
+
+    def __delitem__(self, channel):
+        with self.lock:
+            if channel in self.unloaded:
+                self.unloaded.discard(channel)
+            else:
+                del self.loaded[channel]
+
+    def __contains__(self, channel):
+        return self.get(channel) is not None
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.loaded) + list(self.unloaded))
+
+    def __len__(self):
+        return len(self.loaded) + len(self.unloaded)
+
+    def deadlines(self):
+        """Yield (channel, mask, expiry, timed) for every stored deadline,
+        without loading any shard"""
+        with self.lock:
+            loaded = list(self.loaded.items())
+            stored = [(channel, self.stored.get(channel, {})) for channel in self.unloaded]
+        for (channel, masks) in loaded:
+            for (mask, v) in masks.items():
+                if len(v) >= 4:
+                    yield (channel, mask, v[3], len(v) >= 5 and bool(v[4]))
+        for (channel, due) in stored:
+            for (mask, (when, timed)) in due.items():
+                yield (channel, mask, when, timed)
+
+
+def deadlines(db):
+    """Yield (channel, mask, expiry, timed) for every entry of db carrying
+    an expiry timestamp"""
+    if isinstance(db, ShardedDb):
+        yield from db.deadlines()
+        return
+    for (channel, masks) in db.items():
+        for (mask, v) in masks.items():
+            if len(v) >= 4:
+                yield (channel, mask, v[3], len(v) >= 5 and bool(v[4]))
+
+
+class ShardStore(object):
+    """One JSON file per channel (and one for the network list) under
+    shards/, each loaded the first time its channel is used.
+
+    A write only rewrites the shards of the channels that changed, each
+    through a JsonStore so it keeps a .bak of its own.  shards/deadlines.json
+    holds the expiry timestamps the expiry queue needs at startup: those of
+    timed bans and of channel bans not lifted yet, so it stays small.  An
+    existing blacklist.json is split into shards on first use."""
+
+    def __init__(self, path, onLoad=None):
+        self.jsonfile = path
+        self.path = os.path.join(os.path.dirname(path), 'shards')
+        self.manifest = JsonStore(os.path.join(self.path, 'deadlines.json'))
+        self.onLoad = onLoad
+        self.dirty = set()
+        # channel -> {mask: [expiry, timed]}, as in deadlines.json
+        self.deadlines = {}
+        self.lock = threading.Lock()
+
+    def _shard(self, channel):
+        return JsonStore(os.path.join(self.path, urllib.parse.quote(channel, safe='') + '.json'))
+
+    def _due(self, masks, now):
+        """Return the deadlines of masks worth keeping in deadlines.json"""
+        due = {}
+        for (mask, v) in masks.items():
+            timed = len(v) >= 5 and bool(v[4])
+            if len(v) >= 4 and (timed or v[3] > now):
+                due[mask] = [v[3], timed]
+        return due
+
+    def _split(self):
+        """Write blacklist.json and its journal out as shards, if there
+        are any"""
+        db = JournalStore(self.jsonfile).load()
+        if not db:
+            return
+        clean(db)
+        now = time.time()
+        for (channel, masks) in db.items():
+            self._shard(channel)._dump(masks)
+            self.deadlines[channel] = self._due(masks, now)
+        self.manifest._dump(self.deadlines)
+        log.info(f'Blacklist: split {self.jsonfile} into {len(db)} shards in {self.path}')
+
+    def _loadShard(self, channel):
+        shard = self._shard(channel)
+        try:
+            masks = shard.load()
+        except IOError:
+            return {}
+        dropped = clean({channel: masks})
+        if dropped:
+            log.warning(f'Blacklist: dropped {dropped} malformed entries from {shard.path}.')
+        if dropped or not masks:
+            # Rewritten, or removed if nothing is left, on the next write
+            with self.lock:
+                self.dirty.add(channel)
+        return masks
+
+    def load(self):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+            self._split()
+        else:
+            try:
+                self.deadlines = self.manifest.load()
+            except IOError:
+                self.deadlines = {}
+        scopes = [urllib.parse.unquote(name[:-len('.json')]) for name in os.listdir(self.path)
+                  if name.endswith('.json') and name != 'deadlines.json']
+        return ShardedDb(self._loadShard, scopes, self.deadlines, self.onLoad)
+
+    def record(self, channel, mask, entry):
+        with self.lock:
+            self.dirty.add(channel)
+
+    def write(self, snapshot):
+        """Rewrite the shards of the channels changed since the last write,
+        snapshot(channels) returns a copy of just those"""
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+        if not dirty:
+            return
+        try:
+            db = snapshot(dirty)
+            now = time.time()
+            for channel in dirty:
+                shard = self._shard(channel)
+                if channel in db:
+                    shard._dump(db[channel])
+                    self.deadlines[channel] = self._due(db[channel], now)
+                else:
+                    for path in (shard.path, shard.backup):
+                        if os.path.exists(path):
+                            os.remove(path)
+                    self.deadlines.pop(channel, None)
+            self.manifest._dump(self.deadlines)
+        except Exception:
+            with self.lock:
+                self.dirty |= dirty
+            raise
+
+    def compact(self, snapshot):
+        pass
+
+    def close(self):
+        pass
+
+
+class DbWriter(threading.Thread):
+    """The one thread that writes the banlist to disk.
+
+    markDirty() may be called any number of times; notifications arriving
+    within the debounce window are coalesced into a single write.  The db is
+    copied through snapshot() so the plugin can keep mutating it while the
+    file is being written.  observe(ms), if given, is told how long each
+    write took."""
+
+    def __init__(self, store, snapshot, delay, observe=None):
+        super().__init__(name='Blacklist writer', daemon=True)
+        self.store = store
+        self.snapshot = snapshot
+        self.delay = delay
+        self.observe = observe
+        self.dirty = threading.Event()
+        self.stopping = threading.Event()
+        # Set by markDirty(), cleared just before the write that covers it
+        self.pending = False
+        self.compacting = False
+
+    def markDirty(self):
+        self.pending = True
+        self.dirty.set()
+
+    def requestCompact(self):
+        self.compacting = True
+        self.markDirty()
+
+    def run(self):
+        while not self.stopping.is_set():
+            self.dirty.wait()
+            # Debounce, but wake up at once when asked to stop
+            self.stopping.wait(self.delay())
+            self.dirty.clear()
+            self._flushPending()
+        # Changes made while the last write was running
+        self._flushPending()
+
+    def _flushPending(self):
+        if self.pending:
+            self.pending = False
+            self.flush()
+
+    def flush(self):
+        start = time.perf_counter()
+        try:
+            self.store.write(self.snapshot)
+            if self.compacting:
+                self.compacting = False
+                self.store.compact(self.snapshot)
+        except Exception as e:
+            log.exception(f'Blacklist: failed to write {self.store.path}: {e}')
+        if self.observe is not None:
+            self.observe((time.perf_counter() - start) * 1000)
+
+    def stop(self):
+        """Stop the thread and flush whatever is still pending"""
+        self.stopping.set()
+        self.dirty.set()
+        self.join()
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -0,0 +1,124 @@
+###
+# Blacklist - subsume.py
+#
+# Finds masks that can never match a join without a broader mask of the
+# same banlist matching it too, so they can be folded into that mask.
+###
+
+from supybot import ircutils
+
+from .maskindex import MaskIndex, accountName
+from .prefixtree import parseRange
+
+
+def globCovers(broad, narrow):
+    """Return whether glob pattern broad matches every string glob pattern
+    narrow can match; both must already be IRC-lowered"""
+    # done[j]: broad[i:] matches narrow[j:], filled from the end of broad
+    n = len(narrow)
+    done = [False] * n + [True]
+    for i in range(len(broad) - 1, -1, -1):
+        c = broad[i]
+        row = [False] * (n + 1)
+        for j in range(n, -1, -1):
+            if c == '*':
+                row[j] = done[j] or (j < n and row[j+1])
+            elif j == n:
+                row[j] = False
+            elif c == '?':
+                row[j] = narrow[j] != '*' and done[j+1]
+            else:
+                row[j] = narrow[j] == c and done[j+1]
+        done = row
+    return done[0]
+
+
+def covers(broad, narrow):
+    """Return whether ban mask broad matches everyone narrow matches.
+    Only answers yes when that is certain; extbans other than account bans
+    are only covered by an identical mask."""
+    broad = ircutils.toLower(broad)
+    narrow = ircutils.toLower(narrow)
+    if broad == narrow:
+        return True
+    if accountName(broad) is not None or accountName(narrow) is not None:
+        return accountName(broad) == accountName(narrow) and \
+            broad.split(':', 1)[0] == narrow.split(':', 1)[0]
+    if broad.startswith(('$', '~')) or narrow.startswith(('$', '~')):
+        return False
+    broadRange = parseRange(broad)
+    narrowRange = parseRange(narrow)
+    if broadRange is None and narrowRange is None:
+        return globCovers(broad, narrow)
+    if broadRange is None:
+        # Only a host of nothing but wildcards covers a whole range
+        (user, sep, host) = broad.rpartition('@')
+        return bool(sep) and not host.strip('*') and globCovers(user, narrowRange[0])
+    (user, network) = broadRange
+    if narrowRange is not None:
+        return network.version == narrowRange[1].version and \
+            narrowRange[1].subnet_of(network) and globCovers(user, narrowRange[0])
+    # A plain mask is inside a range if its host is a literal address in it
+    parsed = parseRange(narrow + '/' + str(network.max_prefixlen))
+    if parsed is None:
+        return False
+    return network.version == parsed[1].version and \
+        parsed[1].subnet_of(network) and globCovers(user, parsed[0])
+
+
+def sample(mask):
+    """Return a hostmask that mask matches, for finding masks that may
+    cover it through the index"""
+    parsed = parseRange(mask)
+    if parsed is not None:
+        mask = f'{parsed[0]}@{parsed[1].network_address}'
+    return mask.replace('*', 'x').replace('?', 'x')
+
+
+def outlives(broad, narrow):
+    """Return whether db entry broad stays in the db at least as long as
+    entry narrow does"""
+    if not (len(broad) >= 5 and broad[4]):
+        return True
+    return len(narrow) >= 5 and narrow[4] and broad[3] >= narrow[3]
+
+
+def redundant(entries, fold=None):
+    """Return {mask: keeper} for every mask of entries ({mask: db entry})
+    that is covered by a broader mask, keeper, staying in the banlist at
+    least as long.  Of equivalent masks the oldest one is kept."""
+    index = MaskIndex(entries, fold)
+    folded = {mask: fold(mask) if fold else mask for mask in entries}
+    # Masks sharing an account name are covered by each other and nothing
+    # else; the index only finds glob and range masks
+    accounts = {}
+    for mask in entries:
+        if accountName(mask) is not None:
+            accounts.setdefault(accountName(mask), []).append(mask)
+    rank = lambda mask: (entries[mask][1], mask)
+    coveredBy = {}
+    for mask in entries:
+        if accountName(mask) is not None:
+            found = accounts[accountName(mask)]
+        else:
+            probe = sample(folded[mask])
+            found = [other for (other, matcher) in index.candidates(probe)
+                     if matcher(probe) is not None]
+        coveredBy[mask] = [other for other in found if other != mask and
+                           outlives(entries[other], entries[mask]) and
+                           covers(folded[other], folded[mask])]
+    removed = set()
+    for (mask, others) in coveredBy.items():
+        for other in others:
+            # Equivalent masks cover each other, drop all but the oldest
+            if mask not in coveredBy[other] or rank(other) < rank(mask):
+                removed.add(mask)
+                break
+    merges = {}
+    for mask in removed:
+        keepers = [other for other in coveredBy[mask] if other not in removed]
+        if keepers:
+            merges[mask] = min(keepers, key=rank)
+    return merges
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -0,0 +1,972 @@
+###
+# Blacklist - test.py
+###
+
+import http.server, json, os, random, re, shutil, socket, tempfile, threading, time
+
+from supybot import conf, drivers, ircmsgs, ircutils, schedule
+from supybot.test import *
+
+from .confusables import foldNick
+from .maskindex import MaskIndex, MissCache
+from .metrics import Histogram
+from .outqueue import ModerationQueue, kickLines, modeLines
+from . import paste
+from .storage import DbWriter, JournalStore, JsonStore, ShardStore, SqliteHitStore, \
+    SqliteStore, clean
+from .subsume import globCovers, redundant
+from .transfer import detect, readBans
+
+
+def dataDir():
+    return os.path.join(str(conf.supybot.directories.data), 'Blacklist')
+
+class BlacklistTestCase(ChannelPluginTestCase):
+    plugins = ('Blacklist',)
+    config = {'supybot.plugins.Blacklist.enabled': True}
+
+    def setUp(self):
+        super().setUp()
+        self.irc.feedMsg(ircmsgs.op(self.channel, self.nick))
+
+    def drain(self, seconds=1.0):
+        """Run the scheduler for a while and return what the bot sent"""
+        msgs = []
+        end = time.time() + seconds
+        while time.time() < end:
+            drivers.run()
+            msg = self.irc.takeMsg()
+            if msg:
+                msgs.append(msg)
+            else:
+                time.sleep(0.05)
+        return msgs
+
+    def plugin(self):
+        return self.irc.getCallback('Blacklist')
+
+    def reload(self, **config):
+        """Reload the plugin, with the given registry values set first"""
+        for (name, value) in config.items():
+            group = conf.supybot.plugins.Blacklist.get(name)
+            self.originals.setdefault(group, group())
+            group.setValue(value)
+        self.assertNotError('reload Blacklist')
+        self.irc.feedMsg(ircmsgs.op(self.channel, self.nick))
+
+    def testAddKicksOnJoin(self):
+        self.assertNotError('add *!*@bad.example.com spam')
+        msgs = self.drain(0.5)
+        self.irc.feedMsg(ircmsgs.join(self.channel, prefix='evil!u@bad.example.com'))
+        msgs += self.drain()
+        self.assertTrue(any(m.command == 'MODE' and m.args[1:] == ('+b', '*!*@bad.example.com')
+                            for m in msgs), msgs)
+        self.assertTrue(any(m.command == 'KICK' and m.args[1] == 'evil' for m in msgs), msgs)
+
+    def testIndexFollowsRemove(self):
+        self.assertNotError('add *!*@bad.example.com spam')
+        self.assertNotError('add *!*@other.example.com spam')
+        self.assertNotError('remove *!*@bad.example.com')
+        self.drain(0.5)
+        self.irc.feedMsg(ircmsgs.join(self.channel, prefix='evil!u@bad.example.com'))
+        self.assertFalse([m for m in self.drain(0.5) if m.command == 'KICK'])
+        self.assertNotError('remove *!*@other.example.com')
+        self.assertNotIn(self.channel, self.plugin().index)
+
+    def testExpiryAfterReload(self):
+        self.assertNotError('timer *!*@timed.example.com 5 spam')
+        self.assertNotError('add *!*@kept.example.com spam')
+        cb = self.plugin()
+        with cb.lock:
+            cb.db[self.channel]['*!*@timed.example.com'][3] = int(time.time()) - 1
+            cb.store.record(self.channel, '*!*@timed.example.com',
+                            cb.db[self.channel]['*!*@timed.example.com'])
+        cb._dbWrite()
+        self.reload()
+        cb = self.plugin()
+        self.assertIn('*!*@timed.example.com', cb.db[self.channel])
+        self.drain(0.5)
+        self.assertNotIn('*!*@timed.example.com', cb.db[self.channel])
+        self.assertIn('*!*@kept.example.com', cb.db[self.channel])
+
+    def testLiftKeepsEntry(self):
+        self.assertNotError('add *!*@bad.example.com spam')
+        self.irc.feedMsg(ircmsgs.ban(self.channel, '*!*@bad.example.com',
+                                     prefix=self.irc.prefix))
+        self.drain(0.5)
+        cb = self.plugin()
+        now = time.time()
+        cb._scheduleLift(self.channel, '*!*@bad.example.com', now)
+        self.assertEqual(cb.db[self.channel]['*!*@bad.example.com'][3], int(now))
+        msgs = self.drain(1.5)
+        self.assertTrue(any(m.command == 'MODE' and m.args[1:] == ('-b', '*!*@bad.example.com')
+                            for m in msgs), msgs)
+        self.assertIn('*!*@bad.example.com', cb.db[self.channel])
+
+    def testModeLinesFollowModes(self):
+        self.irc.feedMsg(ircmsgs.IrcMsg(':server 005 test MODES=3 :are supported'))
+        changes = [('+b', f'*!*@h{i}.example.com') for i in range(7)]
+        msgs = modeLines(self.irc, self.channel, changes)
+        self.assertEqual([len(m.args) - 2 for m in msgs], [3, 3, 1])
+        self.assertEqual([m.args[1] for m in msgs], ['+bbb', '+bbb', '+b'])
+        self.assertEqual([mask for m in msgs for mask in m.args[2:]],
+                         [mask for (mode, mask) in changes])
+
+    def testModeLinesFitTheLine(self):
+        self.irc.feedMsg(ircmsgs.IrcMsg(':server 005 test MODES=100 :are supported'))
+        changes = [('+b', '*!*@' + 'x' * 100 + f'{i}.example.com') for i in range(20)]
+        msgs = modeLines(self.irc, self.channel, changes)
+        self.assertTrue(len(msgs) > 1)
+        for m in msgs:
+            self.assertTrue(len(f':{self.irc.prefix} {m}'.encode()) <= 512, m)
+
+    def testLiftsWaitAndCoalesce(self):
+        queue = ModerationQueue(lambda channel: 60)
+        masks = [f'*!*@l{n}.example.com' for n in range(3)]
+        for mask in masks:
+            self.irc.feedMsg(ircmsgs.ban(self.channel, mask, prefix=self.irc.prefix))
+        # Anything else pending holds the lifts back
+        queue.kick(self.irc, self.channel, 'nobody', 'r')
+        queue.lift(self.irc, self.channel, masks[0])
+        queue.lift(self.irc, self.channel, masks[1])
+        self.assertFalse([m for m in self.drain(0.5) if m.command == 'MODE'])
+        # A ban cancels the lift of its mask
+        queue.ban(self.irc, self.channel, masks[1])
+        queue.ban(self.irc, self.channel, '*!*@new.example.com')
+        self.assertEqual(queue.queued(self.irc, self.channel), {
+            masks[0]: '-b', masks[1]: '+b', '*!*@new.example.com': '+b'})
+        # and a flushed ban takes the channel's lifts along, ahead of it
+        queue.flush(self.irc, self.channel)
+        modes = [mode for m in self.drain(0.5) if m.command == 'MODE'
+                 for mode in ircutils.separateModes(m.args[1:])]
+        self.assertEqual(modes, [('-b', masks[0]), ('+b', '*!*@new.example.com')])
+        self.assertEqual(queue.depth(), (0, 0))
+        queue.lift(self.irc, self.channel, masks[2])
+        modes = [mode for m in self.drain(0.5) if m.command == 'MODE'
+                 for mode in ircutils.separateModes(m.args[1:])]
+        self.assertEqual(modes, [('-b', masks[2])])
+
+    def testBansBatched(self):
+        self.irc.feedMsg(ircmsgs.IrcMsg(':server 005 test MODES=3 :are supported'))
+        with conf.supybot.plugins.Blacklist.modeBatchDelay.context(2):
+            for i in range(4):
+                self.assertNotError(f'add *!*@h{i}.example.com spam')
+            msgs = [m for m in self.drain(2.5) if m.command == 'MODE']
+        self.assertEqual([m.args[1] for m in msgs], ['+bbb', '+b'])
+
+    def testKickLinesFollowTargmax(self):
+        self.irc.feedMsg(ircmsgs.IrcMsg(':server 005 test TARGMAX=KICK:2,PRIVMSG:3 :are supported'))
+        kicks = [('a', 'spam'), ('b', 'spam'), ('c', 'spam'), ('d', 'flood'), ('e', 'spam')]
+        msgs = kickLines(self.irc, self.channel, kicks)
+        self.assertEqual([(m.args[1], m.args[2]) for m in msgs],
+                         [('a,b', 'spam'), ('c', 'spam'), ('d', 'flood'), ('e', 'spam')])
+
+    def testKickLinesWithoutTargmax(self):
+        kicks = [('a', 'spam'), ('b', 'spam')]
+        msgs = kickLines(self.irc, self.channel, kicks)
+        self.assertEqual([m.args[1] for m in msgs], ['a', 'b'])
+
+    def testKicksFollowTheBan(self):
+        self.irc.feedMsg(ircmsgs.IrcMsg(':server 005 test TARGMAX=KICK:4 :are supported'))
+        for nick in ('a', 'b', 'c'):
+            self.irc.feedMsg(ircmsgs.join(self.channel, prefix=f'{nick}!u@bad.example.com'))
+        self.assertNotError('add *!*@bad.example.com spam')
+        msgs = [m for m in self.drain() if m.command in ('MODE', 'KICK')]
+        self.assertEqual([(m.command, sorted(m.args[1].split(','))) for m in msgs],
+                         [('MODE', ['+b']), ('KICK', ['a', 'b', 'c'])])
+
+    def testChannelHostsFollowUsers(self):
+        for nick in ('a', 'b', 'c', 'd'):
+            self.irc.feedMsg(ircmsgs.join(self.channel, prefix=f'{nick}!u@{nick}.example.com'))
+        cb = self.plugin()
+        hosts = cb._channelHosts(self.irc, self.channel)
+        self.assertEqual(sorted(hosts.match('*!*@*.example.com')), ['a', 'b', 'c', 'd'])
+        self.irc.feedMsg(ircmsgs.join(self.channel, prefix='e!u@e.example.com'))
+        self.irc.feedMsg(ircmsgs.nick('a2', prefix='a!u@a.example.com'))
+        self.irc.feedMsg(ircmsgs.IrcMsg(prefix='b!u@b.example.com', command='CHGHOST',
+                                        args=('v', 'new.example.com')))
+        self.irc.feedMsg(ircmsgs.part(self.channel, prefix='c!u@c.example.com'))
+        self.irc.feedMsg(ircmsgs.quit(prefix='d!u@d.example.com'))
+        self.irc.feedMsg(ircmsgs.kick(self.channel, 'e', prefix=self.prefix))
+        self.assertIs(cb._channelHosts(self.irc, self.channel), hosts)
+        self.assertEqual(sorted(hosts.match('*!*@*.example.com')), ['a2', 'b'])
+        self.assertEqual(hosts.match('*!v@new.example.com'), ['b'])
+        self.assertEqual(hosts.match('A2!*@*'), ['a2'])
+        self.irc.feedMsg(ircmsgs.part(self.channel, prefix=self.irc.prefix))
+        self.assertNotIn((self.irc.network, self.channel), cb.hosts)
+
+    def testMissCacheSurvivesEntryUpdates(self):
+        cb = self.plugin()
+        self.assertNotError('add *!*@bad.example.com spam')
+        self.irc.feedMsg(ircmsgs.join(self.channel, prefix='good!u@ok.example.com'))
+        self.assertEqual(len(cb.misses), 1)
+        generation = cb.generation[self.channel]
+        # Persisting a new lift time rewrites the entry, not the masks
+        entry = list(cb.db[self.channel]['*!*@bad.example.com'])
+        entry[3] += 60
+        cb._dbSet(self.channel, '*!*@bad.example.com', entry)
+        self.assertEqual(cb.generation[self.channel], generation)
+        self.assertTrue(cb.misses.hit(self.channel, 'good!u@ok.example.com', (generation,)))
+        self.assertNotError('add *!*@ok.example.com spam')
+        self.assertNotEqual(cb.generation[self.channel], generation)
+        self.drain(0.5)
+        self.irc.feedMsg(ircmsgs.join(self.channel, prefix='good!u@ok.example.com'))
+        self.assertTrue([m for m in self.drain() if m.command == 'KICK'])
+
+    def testListPasteIsReused(self):
+        self.assertNotError('add *!*@bad.example.com spam')
+        with conf.supybot.plugins.Blacklist.pasteService.context('file'):
+            m = self.assertRegexp('blacklist list', r'\(1 entries\): ')
+            path = m.args[1].split(': ', 1)[1]
+            with open(path) as f:
+                self.assertIn('*!*@bad.example.com', f.read())
+            cb = self.plugin()
+            cb.paster.upload = lambda *args: self.fail('uploaded again')
+            self.assertResponse('blacklist list', m.args[1])
+            del cb.paster.upload
+            # Any change to the entries makes a new paste
+            self.assertNotError('add *!*@other.example.com spam')
+            self.assertNotRegexp('blacklist list', re.escape(path))
+
+    def testHttpPasteNeedsTarget(self):
+        self.assertNotError('add *!*@bad.example.com spam')
+        group = conf.supybot.plugins.Blacklist
+        with group.pasteService.context('http'):
+            self.assertError('blacklist list')
+            self.assertRegexp('blacklist list', 'pasteTarget must be set')
+            # Short enough to reply with, nothing to paste
+            with group.maxListOutput.context(10):
+                self.assertRegexp('blacklist list', r'^\*!\*@bad\.example\.com - Added by')
+
+    def testNetworkList(self):
+        self.assertNotError('network add *!*@net.example.com spam')
+        self.assertNotError('add *!*@*.example.com local')
+        with conf.supybot.plugins.Blacklist.maxListOutput.context(10):
+            self.assertRegexp('network list', r'^\*!\*@net\.example\.com - Added by test')
+        self.drain(0.5)
+        # The channel's own entry wins over the network one
+        self.irc.feedMsg(ircmsgs.join(self.channel, prefix='evil!u@net.example.com'))
+        kicks = [m for m in self.drain() if m.command == 'KICK']
+        self.assertEqual([m.args[2] for m in kicks], ['local'])
+        self.assertNotError('remove *!*@*.example.com')
+        self.irc.feedMsg(ircmsgs.join(self.channel, prefix='evil!u@net.example.com'))
+        msgs = self.drain()
+        self.assertTrue(any(m.command == 'MODE' and m.args[1:] == ('+b', '*!*@net.example.com')
+                            for m in msgs), msgs)
+        self.assertEqual([m.args[2] for m in msgs if m.command == 'KICK'], ['spam'])
+        self.irc.feedMsg(ircmsgs.ban(self.channel, '*!*@net.example.com', prefix=self.irc.prefix))
+        self.assertNotError('network remove *!*@net.example.com')
+        # Removed by hand: a plain unban, not a lift behind other traffic
+        queue = self.plugin().queue
+        self.assertFalse(queue.lifts.get(self.irc.network))
+        self.assertEqual(queue.pending[(self.irc.network, self.channel)]['modes'],
+                         {'*!*@net.example.com': '-b'})
+        msgs = self.drain()
+        self.assertTrue(any(m.command == 'MODE' and m.args[1:] == ('-b', '*!*@net.example.com')
+                            for m in msgs), msgs)
+
+    def testNetworkListOptOut(self):
+        self.assertNotError('network add *!*@net.example.com spam')
+        self.drain(0.5)
+        group = conf.supybot.plugins.Blacklist.useNetworkList.get(self.channel)
+        with group.context(False):
+            self.irc.feedMsg(ircmsgs.join(self.channel, prefix='evil!u@net.example.com'))
+            self.assertFalse([m for m in self.drain() if m.command == 'KICK'])
+        self.irc.feedMsg(ircmsgs.join(self.channel, prefix='evil2!u@net.example.com'))
+        self.assertTrue([m for m in self.drain() if m.command == 'KICK'])
+
+    def testReconcileOnBanlist(self):
+        cb = self.plugin()
+        now = int(time.time())
+        for mask in ('*!*@overdue.example.com', '*!*@adopt.example.com'):
+            cb._dbSet(self.channel, mask, ['x', now, 'r', now + 600, False])
+        cb._dbSet('*', '*!*@net.example.com', ['x', now, 'r', now + 600, False])
+        cb._unbanAt[(self.channel, '*!*@overdue.example.com')] = now - 10
+        cb._unbanAt[(self.channel, '*!*@gone.example.com')] = now + 10
+        msgs = [self.getMsg('sync')] + self.drain(0.2)
+        self.assertTrue(any(m.command == 'MODE' and m.args[1:] == ('+b',) for m in msgs), msgs)
+        self.assertTrue(any(m.command == 'PRIVMSG' and 'Fetching the banlist' in m.args[1]
+                            for m in msgs), msgs)
+        for mask in ('*!*@overdue.example.com', '*!*@adopt.example.com',
+                     '*!*@net.example.com', '*!*@foreign.example.com'):
+            self.irc.feedMsg(ircmsgs.IrcMsg(f':server 367 test {self.channel} {mask} x {now}'))
+        self.irc.feedMsg(ircmsgs.IrcMsg(f':server 368 test {self.channel} :End of Channel Ban List'))
+        msgs = [m for m in self.drain() if m.command == 'MODE']
+        self.assertEqual([m.args[1:] for m in msgs], [('-b', '*!*@overdue.example.com')])
+        self.assertEqual(sorted(mask for (channel, mask) in cb._unbanAt),
+                         ['*!*@adopt.example.com', '*!*@net.example.com'])
+        self.irc.feedMsg(ircmsgs.unban(self.channel, '*!*@overdue.example.com',
+                                       prefix=self.irc.prefix))
+        # Removed by an op: no lift left to send
+        self.irc.feedMsg(ircmsgs.unban(self.channel, '*!*@adopt.example.com',
+                                       prefix='op!o@op.example.com'))
+        self.assertNotIn((self.channel, '*!*@adopt.example.com'), cb._unbanAt)
+        self.assertResponse('sync', f'Banlist for {self.channel} reconciled: 0 bans lifted, '
+                            '0 lift times restored, 0 manual removals noted.')
+
+    def testBanSlotRotation(self):
+        self.irc.feedMsg(ircmsgs.IrcMsg(':server 005 test MAXLIST=b:5 :are supported'))
+        cb = self.plugin()
+        now = int(time.time())
+        for (n, mask) in enumerate(('*!*@a.example.com', '*!*@b.example.com')):
+            cb._dbSet(self.channel, mask, ['x', now, 'r', now + 600, False])
+            cb._lastHit[(self.channel, mask)] = now - 100 + n
+        for mask in ('*!*@a.example.com', '*!*@b.example.com'):
+            self.irc.feedMsg(ircmsgs.ban(self.channel, mask, prefix=self.irc.prefix))
+        # Set by services, never lifted by us
+        self.irc.feedMsg(ircmsgs.ban(self.channel, '*!*@services.example.com',
+                                     prefix='ChanServ!cs@services.'))
+        self.assertNotError('add *!*@n.example.com spam')
+        msgs = [m for m in self.drain() if m.command == 'MODE']
+        self.assertEqual([m.args[1:] for m in msgs], [('-b', '*!*@a.example.com'),
+                                                      ('-b', '*!*@b.example.com'),
+                                                      ('+b', '*!*@n.example.com')])
+        self.assertIn('*!*@a.example.com', cb.db[self.channel])
+        # The server disagrees about the room left: make more and retry
+        self.irc.feedMsg(ircmsgs.unban(self.channel, '*!*@n.example.com', prefix=self.irc.prefix))
+        self.irc.feedMsg(ircmsgs.ban(self.channel, '*!*@b.example.com', prefix=self.irc.prefix))
+        full = f':server 478 test {self.channel} *!*@n.example.com :Channel ban list is full'
+        self.irc.feedMsg(ircmsgs.IrcMsg(full))
+        msgs = [m for m in self.drain() if m.command == 'MODE']
+        self.assertEqual([m.args[1:] for m in msgs], [('-b', '*!*@b.example.com'),
+                                                      ('+b', '*!*@n.example.com')])
+        # Nothing of ours left to make room with
+        self.irc.feedMsg(ircmsgs.unban(self.channel, '*!*@n.example.com', prefix=self.irc.prefix))
+        self.irc.feedMsg(ircmsgs.IrcMsg(full))
+        self.assertFalse([m for m in self.drain() if m.command == 'MODE'])
+    def testEvictionUsesSavedHits(self):
+        self.irc.feedMsg(ircmsgs.IrcMsg(':server 005 test MAXLIST=b:7 :are supported'))
+        cb = self.plugin()
+        now = int(time.time())
+        # As loaded from hits.json after a restart, with _lastHit empty
+        ages = {self.channel: {'a': 50, 'b': 300, 'c': 10, 'd': 400, 'e': 20},
+                '*': {'g': 200}}
+        for (scope, masks) in ages.items():
+            for (host, age) in masks.items():
+                mask = f'*!*@{host}.example.com'
+                cb._dbSet(scope, mask, ['x', now, 'r', now + 600, False])
+                cb.hits.setdefault(scope, {})[mask] = [1, now - age]
+                self.irc.feedMsg(ircmsgs.ban(self.channel, mask, prefix=self.irc.prefix))
+        cb._lastHit.clear()
+        self.assertNotError('add *!*@n.example.com spam')
+        msgs = [m for m in self.drain() if m.command == 'MODE']
+        self.assertEqual([m.args[1:] for m in msgs], [('-b', '*!*@d.example.com'),
+                                                      ('-b', '*!*@b.example.com'),
+                                                      ('-b', '*!*@g.example.com'),
+                                                      ('+b', '*!*@n.example.com')])
+
+    def testHitsCountedAndKept(self):
+        self.assertNotError('add *!*@a.example.com spam')
+        self.assertNotError('add *!*@b.example.com spam')
+        for nick in ('x', 'y'):
+            self.irc.feedMsg(ircmsgs.join(self.channel, prefix=f'{nick}!u@a.example.com'))
+        self.drain()
+        self.assertEqual(self.plugin().hits[self.channel]['*!*@a.example.com'][0], 2)
+        self.reload()
+        self.assertRegexp('stats', r'Top masks for #test: \*!\*@a\.example\.com \(2 hits, last')
+        self.assertRegexp(' ', r'1 of 2 masks never matched: \*!\*@b\.example\.com$')
+
+    def testMetrics(self):
+        self.assertNotError('add *!*@bad.example.com spam')
+        self.irc.feedMsg(ircmsgs.join(self.channel, prefix='a!u@ok.example.com'))
+        self.irc.feedMsg(ircmsgs.join(self.channel, prefix='b!u@bad.example.com'))
+        m = self.assertRegexp('metrics --reset', r'joinMatches: 1 \| joins: 2 \|')
+        self.assertIn('joinCheck: n=2 ', m.args[1])
+        self.assertNotRegexp('metrics', 'joins:')
+
+    def testFoldConfusables(self):
+        self.reload(foldConfusables=True)
+        # Cyrillic Е and ѵ
+        self.irc.feedMsg(ircmsgs.join(self.channel, prefix='\u0415\u0475il!u@a.example.com'))
+        self.assertNotError('add evil!*@* spam')
+        msgs = self.drain()
+        self.assertEqual([m.args[1] for m in msgs if m.command == 'KICK'], ['\u0415\u0475il'])
+        # Cherokee Ꮮ
+        self.irc.feedMsg(ircmsgs.join(self.channel, prefix='EVI\u13de!u@b.example.com'))
+        msgs = self.drain()
+        self.assertEqual([m.args[1] for m in msgs if m.command == 'KICK'], ['EVI\u13de'])
+
+    def testCreateMask(self):
+        self.irc.feedMsg(ircmsgs.join(self.channel, prefix='a!id@user.isp.example.com'))
+        self.irc.feedMsg(ircmsgs.join(self.channel, prefix='b!id@cloak'))
+        cb = self.plugin()
+        self.assertEqual([cb._createMask(self.irc, 'a', num) for num in (2, 3, 4, 8, 9)],
+                         ['*!*@user.isp.example.com', '*!*id@*.isp.example.com',
+                          '*!*@*.isp.example.com', 'a!*id@*.isp.example.com',
+                          'a!*@*.isp.example.com'])
+        self.assertEqual([cb._createMask(self.irc, 'b', num) for num in (2, 3, 4, 8, 9)],
+                         ['*!*@cloak', '*!*id@cloak', '*!*@cloak', 'b!*id@cloak', 'b!*@cloak'])
+        with conf.supybot.plugins.Blacklist.maskNumber.get(self.channel).context(4):
+            self.assertResponse('add b', f'"*!*@cloak" added to the banlist for {self.channel}.')
+
+    def testRangeBan(self):
+        self.irc.feedMsg(ircmsgs.join(self.channel, prefix='in!u@203.0.113.7'))
+        self.irc.feedMsg(ircmsgs.join(self.channel, prefix='out!u@203.0.114.7'))
+        self.assertNotError('add *!*@203.0.113.0/24 spam')
+        self.irc.feedMsg(ircmsgs.join(self.channel, prefix='in2!u@203.0.113.200'))
+        kicks = [m.args[1] for m in self.drain() if m.command == 'KICK']
+        self.assertEqual(kicks, ['in', 'in2'])
+
+    def testRangeWouldBanMe(self):
+        # Commands come from the bot's own nick, so this moves the bot too
+        self.prefix = 'test!test@10.9.8.7'
+        self.assertRegexp('add *!*@10.9.0.0/16', 'blacklist myself')
+        self.assertEqual(self.irc.prefix, self.prefix)
+        self.assertRegexp('timer *!*@10.9.8.0/24 10', 'blacklist myself')
+        self.assertRegexp('network add *!*@10.0.0.0/8', 'blacklist myself')
+        self.assertNotError('add *!*@10.8.0.0/16')
+
+    def testAccountBans(self):
+        self.assertNotError('add ~a:Evil spam')
+        self.assertRegexp('add ~q:evil!*@*', 'Extbans are not supported')
+        self.irc.state.capabilities_ack.add('extended-join')
+        self.irc.feedMsg(ircmsgs.IrcMsg(prefix='x!u@a.example.com', command='JOIN',
+                                        args=(self.channel, 'evil', 'Real name')))
+        self.irc.feedMsg(ircmsgs.IrcMsg(prefix='y!u@b.example.com', command='JOIN',
+                                        args=(self.channel, '*', 'Real name')))
+        self.assertEqual([m.args[1] for m in self.drain() if m.command == 'KICK'], ['x'])
+        self.irc.feedMsg(ircmsgs.IrcMsg(prefix='y!u@b.example.com', command='ACCOUNT',
+                                        args=('EVIL',)))
+        self.assertEqual([m.args[1] for m in self.drain() if m.command == 'KICK'], ['y'])
+
+    def testJournalCompactedOnUnload(self):
+        self.reload(storage='journal')
+        self.assertNotError('add *!*@journal.example.com spam')
+        self.reload(storage='json')
+        with open(os.path.join(dataDir(), 'blacklist.json')) as f:
+            self.assertIn('*!*@journal.example.com', json.load(f)[self.channel])
+        self.assertIn('*!*@journal.example.com', self.plugin().db[self.channel])
+
+    def testImportExportRoundtrip(self):
+        os.makedirs(dataDir(), exist_ok=True)
+        with open(os.path.join(dataDir(), 'list.txt'), 'w') as f:
+            f.write('# comment\n*!*@a.example.com spam here\n\nbogus\n*!*@a.example.com dup\n')
+            f.write('*!*@*.domain.tld\n*!*@host.domain.tld\n')
+            for i in range(500):
+                f.write(f'*!*@h{i}.bulk.example.com\n')
+        # Already listed and matching the bot: stays, the imported ones go
+        self.plugin()._dbSet(self.channel, '*!*@*.tld', ['test', 1, 'old', 2, False])
+        self.assertRegexp('import list.txt', r'Imported 501 masks \(text\).*1 were already '
+                          r'listed, 3 were unusable')
+        cb = self.plugin()
+        entry = cb.db[self.channel]['*!*@a.example.com']
+        self.assertEqual(entry[2], 'spam here')
+        self.assertTrue(entry[3] > time.time())
+        self.assertNotIn('*!*@*.domain.tld', cb.db[self.channel])
+        self.assertNotIn('*!*@host.domain.tld', cb.db[self.channel])
+        self.assertTrue(cb._match(self.channel, 'x!y@h42.bulk.example.com'))
+        self.assertError('import ../../etc/passwd')
+        for fmt in ('json', 'autoban', 'text'):
+            self.assertRegexp(f'blacklist export --format {fmt} out.{fmt}', 'Exported 502 masks')
+        # Never over the plugin's own files
+        self.assertRegexp('blacklist export ../blacklist.json', 'only')
+        with open(os.path.join(dataDir(), 'exports', 'out.json')) as f:
+            self.assertEqual(json.load(f)[self.channel], cb.db[self.channel])
+        for fmt in ('json', 'autoban', 'text'):
+            with open(os.path.join(dataDir(), 'exports', f'out.{fmt}')) as f:
+                self.assertEqual(detect(f), fmt)
+            self.assertRegexp(f'network import exports/out.{fmt}', f'masks \\({fmt}\\)')
+        self.assertEqual(set(cb.db['*']), set(cb.db[self.channel]) - {'*!*@*.tld'})
+
+    def testShardedLoadsOnFirstUse(self):
+        shards = os.path.join(dataDir(), 'shards')
+        os.makedirs(shards)
+        with open(os.path.join(shards, '%23other.json'), 'w') as f:
+            json.dump({'*!*@other.example.com': ['x', 1, 'r', 2, False]}, f)
+        # Unreadable, and no .bak to fall back on
+        with open(os.path.join(shards, '%23test.json'), 'w') as f:
+            f.write('{"*!*@broken')
+        self.reload(storage='sharded')
+        cb = self.plugin()
+        # The plugin module was reloaded, so compare by name
+        self.assertEqual(type(cb.db).__name__, 'ShardedDb')
+        self.assertEqual(cb.db.loaded, {})
+        self.irc.feedMsg(ircmsgs.join(self.channel, prefix='someone!u@ok.example.com'))
+        self.assertNotIn(self.channel, cb.db)
+        self.assertEqual(list(cb.db.loaded), [])
+        self.assertNotError('add *!*@new.example.com spam')
+        cb.writer.flush()
+        self.assertNotIn('#other', cb.db.loaded)
+        with open(os.path.join(shards, '%23test.json')) as f:
+            self.assertEqual(list(json.load(f)), ['*!*@new.example.com'])
+
+    def testCompactionScheduledWithJournal(self):
+        self.assertNotIn('bl_compact', schedule.schedule.events)
+        self.reload(storage='journal')
+        self.assertIn('bl_compact', schedule.schedule.events)
+
+    def testIndexCompiledOnFirstMatch(self):
+        self.assertNotError('add *!*@a.example.com spam')
+        self.reload()
+        cb = self.plugin()
+        self.assertNotIn(self.channel, cb.index)
+        self.irc.feedMsg(ircmsgs.join(self.channel, prefix='x!u@a.example.com'))
+        self.assertIn(self.channel, cb.index)
+        self.assertEqual([m.args[1] for m in self.drain() if m.command == 'KICK'], ['x'])
+
+    def testRecheckOnChanges(self):
+        self.assertNotError('add *!*@bad.example.com spam')
+        self.assertNotError('add evil!*@* spam')
+        self.assertNotError('add $a:acct spam')
+        for nick in ('a', 'b', 'c'):
+            self.irc.feedMsg(ircmsgs.join(self.channel, prefix=f'{nick}!u@{nick}.example.com'))
+        self.assertFalse([m for m in self.drain() if m.command == 'KICK'])
+        self.irc.feedMsg(ircmsgs.IrcMsg(prefix='a!u@a.example.com', command='NICK',
+                                        args=('evil',)))
+        self.irc.feedMsg(ircmsgs.IrcMsg(prefix='b!u@b.example.com', command='CHGHOST',
+                                        args=('u', 'bad.example.com')))
+        self.irc.feedMsg(ircmsgs.IrcMsg(prefix='c!u@c.example.com', command='ACCOUNT',
+                                        args=('acct',)))
+        self.assertEqual(sorted(m.args[1] for m in self.drain() if m.command == 'KICK'),
+                         ['b', 'c', 'evil'])
+        self.assertRegexp('metrics', r'recheckMatches: 3 \| rechecks: 3 \|')
+
+    def testManualBansCaptured(self):
+        self.irc.feedMsg(ircmsgs.ban(self.channel, '*!*@chanserv.example.com',
+                                     prefix='ChanServ!cs@services.'))
+        self.irc.feedMsg(ircmsgs.ban(self.channel, '~q:*!*@quiet.example.com',
+                                     prefix='op!o@op.example.com'))
+        self.irc.feedMsg(ircmsgs.ban(self.channel, '*!*@manual.example.com',
+                                     prefix='op!o@op.example.com'))
+        self.assertRegexp(' ', '"\*!\*@manual.example.com" added to the banlist')
+        self.assertEqual(list(self.plugin().db[self.channel]), ['*!*@manual.example.com'])
+        self.assertNotError('remove *!*@manual.example.com')
+
+    def testDedup(self):
+        self.assertNotError('add *!*@*.example.com spam')
+        self.assertNotError('add *!*@a.example.com spam')
+        self.assertNotError('add *!*@b.example.org spam')
+        self.drain(1.5)
+        # The keeper is not set, it takes over the slot of the merged mask
+        self.irc.feedMsg(ircmsgs.unban(self.channel, '*!*@*.example.com',
+                                       prefix='op!o@op.example.com'))
+        self.assertResponse('dedup', '1 of 3 masks in the banlist for #test are covered by '
+                            'broader ones: *!*@a.example.com (by *!*@*.example.com) | 0 of them '
+                            'are tried on every join, 1 hold a ban slot. Use --apply to merge them.')
+        self.assertIn('*!*@a.example.com', self.plugin().db[self.channel])
+        msgs = [self.getMsg('dedup --apply')] + self.drain(1.5)
+        self.assertTrue(any(m.command == 'PRIVMSG' and m.args[1].startswith('Merged: 1 of 3')
+                            for m in msgs), msgs)
+        self.assertEqual(sorted(self.plugin().db[self.channel]),
+                         ['*!*@*.example.com', '*!*@b.example.org'])
+        modes = [mode for m in msgs if m.command == 'MODE'
+                 for mode in ircutils.separateModes(m.args[1:])]
+        self.assertEqual(modes, [('-b', '*!*@a.example.com'), ('+b', '*!*@*.example.com')])
+        self.assertResponse('dedup', 'No mask in the banlist for #test is covered by another.')
+
+
+class BlacklistMaskIndexTestCase(SupyTestCase):
+    def testAgreesWithHostmaskPatternEqual(self):
+        rng = random.Random(1)
+        parts = ['a', 'b', 'ab', 'x1', '[a]', '{a}', '^', '~a']
+        def piece(wild):
+            s = ''.join(rng.choice(parts) for _ in range(rng.randrange(1, 3)))
+            if wild and rng.random() < 0.5:
+                s = s[:rng.randrange(len(s) + 1)] + rng.choice('*?') + s[rng.randrange(len(s) + 1):]
+            return s
+        def host(wild):
+            return '.'.join(piece(wild) for _ in range(rng.randrange(1, 4)))
+        masks = {f'{piece(True)}!{piece(True)}@{host(True)}' for _ in range(300)}
+        masks |= {'*!*@*', 'a*!*@*', '*!*@1.2.3.0/24', '*!*@a.b'}
+        index = MaskIndex(masks)
+        hostmasks = [f'{piece(False)}!{piece(False)}@{host(False)}' for _ in range(300)]
+        hostmasks += ['A!B@A.B', 'x!y@1.2.3.4', '[a]!{a}@^.~a']
+        for hostmask in hostmasks:
+            expected = {mask for mask in masks if '/' not in mask and
+                        ircutils.hostmaskPatternEqual(mask, hostmask)}
+            found = {mask for (mask, matcher) in index.candidates(hostmask)
+                     if matcher(hostmask) is not None}
+            self.assertEqual(found - {'*!*@1.2.3.0/24'}, expected, hostmask)
+            self.assertEqual(index.match(hostmask) is not None, bool(found), hostmask)
+        self.assertIn(index.match('x!y@1.2.3.4'), {'*!*@*', '*!*@1.2.3.0/24'})
+        index.discard('*!*@1.2.3.0/24')
+        self.assertEqual(index.match('x!y@1.2.3.4'), '*!*@*')
+        index.discard('*!*@*')
+        self.assertEqual(index.match('x!y@1.2.3.4'), None)
+
+    def testMissCacheIsBounded(self):
+        misses = MissCache(lambda: 2)
+        misses.add('#a', 'A!u@h', 1)
+        misses.add('#a', 'b!u@h', 1)
+        self.assertTrue(misses.hit('#a', 'a!U@H', 1))
+        self.assertFalse(misses.hit('#a', 'a!u@h', 2))
+        misses.add('#a', 'c!u@h', 1)
+        self.assertEqual(len(misses), 2)
+        self.assertFalse(misses.hit('#a', 'b!u@h', 1))
+        self.assertTrue(misses.hit('#a', 'a!u@h', 1))
+
+    def testHotMasksFirst(self):
+        index = MaskIndex(['*!*@*', '*!*@h.example.com'])
+        self.assertEqual(index.match('x!y@h.example.com'), '*!*@h.example.com')
+        index.touch('*!*@*')
+        self.assertEqual(index.match('x!y@h.example.com'), '*!*@*')
+        index.discard('*!*@*')
+        self.assertEqual(index.match('x!y@h.example.com'), '*!*@h.example.com')
+
+    def testFoldedIndex(self):
+        self.assertEqual(foldNick('\u0415\u0475il!\u0455ome@h\u0455.example.com'),
+                         'evil!\u0455ome@h\u0455.example.com')
+        self.assertEqual(foldNick('n0pe!*@*'), foldNick('nOpe!*@*'))
+        masks = ['evil!*@*', '*!*@h.example.com']
+        self.assertEqual(MaskIndex(masks).match('\u0415\u0475il!u@x'), None)
+        index = MaskIndex(masks, foldNick)
+        self.assertEqual(index.match('\u0415\u0475il!u@x'), 'evil!*@*')
+        self.assertEqual(index.match('\u0415vil!u@h.example.com'), '*!*@h.example.com')
+
+    def testRanges(self):
+        masks = ['*!*@203.0.113.0/24', 'bad*!*@2001:db8::/32', '*!*@10.0.0.0/8',
+                 '*!*@10.1.0.0/16']
+        index = MaskIndex(masks)
+        self.assertEqual(len(index.ranges), 4)
+        self.assertEqual(index.match('x!y@203.0.113.9'), '*!*@203.0.113.0/24')
+        self.assertEqual(index.match('x!y@203.0.114.1'), None)
+        self.assertEqual(index.match('badguy!u@2001:db8:1::5'), 'bad*!*@2001:db8::/32')
+        self.assertEqual(index.match('good!u@2001:db8::1'), None)
+        self.assertEqual(index.match('x!y@10.1.2.3'), '*!*@10.0.0.0/8')
+        self.assertEqual(index.match('x!y@203.0.113.9.example.com'), None)
+        self.assertEqual({mask for (mask, matcher) in index.candidates('x!y@10.1.2.3')},
+                         {'*!*@10.0.0.0/8', '*!*@10.1.0.0/16'})
+        index.discard('*!*@10.0.0.0/8')
+        self.assertEqual(index.match('x!y@10.1.2.3'), '*!*@10.1.0.0/16')
+        for mask in masks:
+            index.discard(mask)
+        self.assertEqual(len(index.ranges), 0)
+        self.assertEqual(index.ranges.roots, {4: [None, None, {}], 6: [None, None, {}]})
+
+    def testAccounts(self):
+        index = MaskIndex(['$a:Evil', '~a:other', '$a:wild*', '*!*@host.example.com'])
+        self.assertEqual(index.match('x!y@elsewhere', 'evil'), '$a:Evil')
+        self.assertEqual(index.match('x!y@elsewhere', 'OTHER'), '~a:other')
+        self.assertEqual(index.match('x!y@elsewhere', 'good'), None)
+        self.assertEqual(index.match('x!y@elsewhere', 'wildcard'), None)
+        self.assertEqual(index.match('x!y@host.example.com', 'good'), '*!*@host.example.com')
+        index.discard('$a:Evil')
+        self.assertEqual(index.match('x!y@elsewhere', 'evil'), None)
+
+
+class BlacklistSubsumeTestCase(SupyTestCase):
+    def testGlobCovers(self):
+        self.assertTrue(globCovers('*!*@*.example.com', '*!*@a.example.com'))
+        self.assertFalse(globCovers('*!*@a.example.com', '*!*@*.example.com'))
+        self.assertTrue(globCovers('*!*@*', 'a!b@c'))
+        self.assertTrue(globCovers('a*', 'a?b'))
+        self.assertTrue(globCovers('*!*@a?.com', '*!*@ab.com'))
+        self.assertFalse(globCovers('?!*@*', '*!*@*'))
+        self.assertFalse(globCovers('*!*@*.com', '*!*@com'))
+
+    def testRedundant(self):
+        permanent = lambda added: ['x', added, 'r', 0, False]
+        entries = {
+            '*!*@*.example.com': permanent(10),
+            '*!*@a.example.com': permanent(20),
+            '*!*@1.2.0.0/16': permanent(10),
+            '*!*@1.2.3.4': permanent(20),
+            '*!*@1.3.3.4': permanent(20),
+            '$a:evil': permanent(20),
+            '$a:Evil': permanent(10),
+            '*!*@Same.example.org': permanent(5),
+            '*!*@same.example.org': permanent(3),
+            # A timed ban does not stand in for a permanent one
+            '*!*@*.example.net': ['x', 10, 'r', 100, True],
+            '*!*@a.example.net': permanent(20),
+        }
+        self.assertEqual(redundant(entries), {
+            '*!*@a.example.com': '*!*@*.example.com',
+            '*!*@1.2.3.4': '*!*@1.2.0.0/16',
+            '$a:evil': '$a:Evil',
+            '*!*@Same.example.org': '*!*@same.example.org',
+        })
+        entries['*!*@*.example.net'] = permanent(10)
+        self.assertEqual(redundant(entries)['*!*@a.example.net'], '*!*@*.example.net')
+
+
+class BlacklistMetricsTestCase(SupyTestCase):
+    def testHistogram(self):
+        histogram = Histogram()
+        self.assertEqual(histogram.summary(), 'no data')
+        for value in [0.3] * 98 + [40, 7000]:
+            histogram.observe(value)
+        self.assertEqual(histogram.percentile(0.5), 0.5)
+        self.assertEqual(histogram.percentile(0.99), 50)
+        self.assertEqual(histogram.percentile(1), 7000)
+        self.assertEqual(histogram.summary(), 'n=100 avg=70.7 p50=0.5 p99=50 max=7e+03')
+
+
+class BlacklistPasteTestCase(SupyTestCase):
+    def testConcurrentUploadsShareOne(self):
+        calls = []
+        release = threading.Event()
+        def slow(content, target):
+            calls.append(content)
+            release.wait(5)
+            return f'{target}/1'
+        urls = []
+        done = threading.Semaphore(0)
+        def callback(url):
+            urls.append(url)
+            done.release()
+        paste.services['slow'] = slow
+        try:
+            paster = paste.Paster()
+            paster.upload('k', 'slow', 'x', 'content', callback)
+            paster.upload('k', 'slow', 'x', 'content', callback)
+            release.set()
+            self.assertTrue(done.acquire(timeout=5) and done.acquire(timeout=5))
+            self.assertEqual((calls, urls), (['content'], ['x/1', 'x/1']))
+        finally:
+            del paste.services['slow']
+
+    def testTermbin(self):
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        received = []
+        def serve():
+            (conn, addr) = server.accept()
+            with conn:
+                data = b''
+                while True:
+                    chunk = conn.recv(1024)
+                    if not chunk:
+                        break
+                    data += chunk
+                received.append(data)
+                conn.sendall(b'https://termbin.com/abcd\n\x00')
+        thread = threading.Thread(target=serve)
+        thread.start()
+        try:
+            url = paste.termbin('banlist', f'127.0.0.1:{server.getsockname()[1]}')
+        finally:
+            thread.join(5)
+            server.close()
+        self.assertEqual((url, received), ('https://termbin.com/abcd', [b'banlist']))
+
+    def testHttp(self):
+        received = []
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                received.append(self.rfile.read(int(self.headers['Content-Length'])))
+                self.send_response(201)
+                self.end_headers()
+                self.wfile.write(b'https://paste.example/xyz\n')
+            def log_message(self, *args):
+                pass
+        server = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.handle_request)
+        thread.start()
+        try:
+            url = paste.http('banlist', f'http://127.0.0.1:{server.server_port}/')
+        finally:
+            thread.join(5)
+            server.server_close()
+        self.assertEqual((url, received), ('https://paste.example/xyz', [b'banlist']))
+
+    def testLocalFile(self):
+        target = tempfile.mkdtemp()
+        try:
+            path = paste.localFile('banlist', os.path.join(target, 'pastes'))
+            with open(path) as f:
+                self.assertEqual(f.read(), 'banlist')
+            self.assertEqual(paste.localFile('banlist', os.path.join(target, 'pastes')), path)
+        finally:
+            shutil.rmtree(target)
+
+
+class BlacklistStorageTestCase(SupyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'blacklist.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+        super().tearDown()
+
+    def testJournalReplayAndCompaction(self):
+        store = JournalStore(self.path)
+        db = store.load()
+        self.assertEqual(db, {})
+        store.record('#a', 'm1', ['x', 1, 'r', 2, False])
+        store.record('#a', 'm2', ['x', 1, 'r', 2, False])
+        store.record('#a', 'm1', None)
+        store.write(lambda: None)
+        with open(store.journal, 'a') as f:
+            # A write cut short by a crash
+            f.write('["#a", "m3", ["x", 1')
+        db = JournalStore(self.path).load()
+        self.assertEqual(db, {'#a': {'m2': ['x', 1, 'r', 2, False]}})
+        store = JournalStore(self.path)
+        store.load()
+        store.compact(lambda: db)
+        self.assertFalse(os.path.exists(store.journal))
+        self.assertFalse(os.path.exists(store.oldjournal))
+        self.assertEqual(JsonStore(self.path).load(), db)
+        self.assertEqual(JournalStore(self.path).load(), db)
+
+    def testCorruptFileFallsBackToBackup(self):
+        store = JsonStore(self.path)
+        store.write(lambda: {'#a': {'m1': ['x', 1, 'r', 2, False]}})
+        store.write(lambda: {'#a': {'m2': ['x', 1, 'r', 2, False]}})
+        with open(self.path, 'w') as f:
+            f.write('{"#a": {"m2"')
+        self.assertEqual(store.load(), {'#a': {'m1': ['x', 1, 'r', 2, False]}})
+        self.assertTrue(os.path.exists(self.path + '.corrupt'))
+        with open(store.backup, 'w') as f:
+            f.write('[]')
+        self.assertEqual(store.load(), {})
+
+    def testMalformedEntriesDropped(self):
+        with open(self.path, 'w') as f:
+            f.write('{"#a": {"m1": ["x", 1, "r", 2, false], "m2": 5}, "#b": []}')
+        db = JsonStore(self.path).load()
+        self.assertEqual(clean(db), 2)
+        self.assertEqual(db, {'#a': {'m1': ['x', 1, 'r', 2, False]}})
+
+    def testWriterFlushesOnStop(self):
+        started = threading.Event()
+        class SlowStore(JsonStore):
+            def write(self, snapshot):
+                data = snapshot()
+                started.set()
+                time.sleep(0.3)
+                self._dump(data)
+        state = {'n': 1}
+        writer = DbWriter(SlowStore(self.path), lambda: dict(state), lambda: 0)
+        writer.start()
+        writer.markDirty()
+        self.assertTrue(started.wait(5))
+        # Changed while the first write is running, then unloaded
+        state['n'] = 2
+        writer.markDirty()
+        writer.stop()
+        self.assertEqual(JsonStore(self.path).load(), {'n': 2})
+
+    def testSqliteChangesAcrossProcesses(self):
+        path = os.path.join(self.dir, 'blacklist.sqlite3')
+        mine, theirs = SqliteStore(path), SqliteStore(path)
+        try:
+            mine.load()
+            theirs.load()
+            theirs.record('#a', 'm1', ['x', 1, 'r', 2, False])
+            theirs.record('#a', 'm2', ['x', 1, 'r', 2, False])
+            theirs.write(None)
+            theirs.record('#a', 'm1', None)
+            theirs.write(None)
+            self.assertEqual(mine.changes(), [('#a', 'm1', ['x', 1, 'r', 2, False]),
+                                              ('#a', 'm2', ['x', 1, 'r', 2, False]),
+                                              ('#a', 'm1', None)])
+            # Our own writes are not handed back
+            mine.record('#a', 'm3', ['x', 1, 'r', 2, False])
+            mine.write(None)
+            self.assertEqual(mine.changes(), [])
+            self.assertEqual(theirs.changes(), [('#a', 'm3', ['x', 1, 'r', 2, False])])
+            self.assertEqual(SqliteStore(path).load(), {'#a': {
+                'm2': ['x', 1, 'r', 2, False], 'm3': ['x', 1, 'r', 2, False]}})
+            # Pruned history that was never read forces a reload
+            theirs.keep = -1
+            theirs.record('#a', 'm4', ['x', 1, 'r', 2, False])
+            theirs.write(None)
+            theirs.compact(None)
+            self.assertEqual(mine.changes(), None)
+        finally:
+            mine.close()
+            theirs.close()
+
+    def testSqliteSeededFromJournal(self):
+        journal = JournalStore(self.path)
+        journal.load()
+        journal.record('#a', 'm1', ['x', 1, 'r', 2, False])
+        journal.write(lambda: None)
+        store = SqliteStore(os.path.join(self.dir, 'blacklist.sqlite3'))
+        try:
+            self.assertEqual(store.load(), {'#a': {'m1': ['x', 1, 'r', 2, False]}})
+        finally:
+            store.close()
+
+    def testSqliteHitsAddUp(self):
+        path = os.path.join(self.dir, 'blacklist.sqlite3')
+        (a, b) = (SqliteStore(path), SqliteStore(path))
+        try:
+            (hitsA, hitsB) = (SqliteHitStore(a), SqliteHitStore(b))
+            (mine, theirs) = (hitsA.load(), hitsB.load())
+            mine['#a'] = {'m': [3, 10]}
+            hitsA.write(lambda: mine)
+            theirs['#a'] = {'m': [2, 20]}
+            hitsB.write(lambda: theirs)
+            mine['#a']['m'] = [4, 30]
+            hitsA.write(lambda: mine)
+            self.assertEqual(SqliteHitStore(a).load(), {'#a': {'m': [6, 30]}})
+            del mine['#a']['m']
+            hitsA.write(lambda: mine)
+            self.assertEqual(SqliteHitStore(a).load(), {})
+        finally:
+            a.close()
+            b.close()
+
+    def testShards(self):
+        now = int(time.time())
+        JsonStore(self.path).write(lambda: {
+            '#a': {'m1': ['x', 1, 'r', now + 600, True]},
+            '#b': {'m2': ['x', 1, 'r', 1, False], 'junk': 5}})
+        journal = JournalStore(self.path)
+        journal.record('#c', 'm3', ['x', 1, 'r', 1, False])
+        journal.write(lambda: None)
+        db = ShardStore(self.path).load()
+        self.assertEqual(sorted(db), ['#a', '#b', '#c'])
+        loaded = []
+        store = ShardStore(self.path, lambda channel, masks: loaded.append(channel))
+        db = store.load()
+        self.assertEqual(db.loaded, {})
+        self.assertEqual(list(db.deadlines()), [('#a', 'm1', now + 600, True)])
+        self.assertEqual(db['#b'], {'m2': ['x', 1, 'r', 1, False]})
+        self.assertEqual(loaded, ['#b'])
+        # Only the changed shard is rewritten; the malformed entry makes
+        # #b's shard due for a rewrite too
+        other = os.path.join(store.path, '%23c.json')
+        before = os.stat(other).st_mtime_ns
+        db['#a'] = {'m4': ['x', 1, 'r', 2, False]}
+        store.record('#a', 'm4', db['#a']['m4'])
+        store.write(lambda channels: {channel: db[channel] for channel in channels})
+        self.assertEqual(os.stat(other).st_mtime_ns, before)
+        self.assertEqual(JsonStore(os.path.join(store.path, '%23b.json')).load(),
+                         {'m2': ['x', 1, 'r', 1, False]})
+        db = ShardStore(self.path).load()
+        self.assertEqual(db['#a'], {'m4': ['x', 1, 'r', 2, False]})
+        self.assertEqual(list(db.deadlines()), [('#a', 'm4', 2, False)])
+
+    def testCorruptShard(self):
+        os.makedirs(os.path.join(self.dir, 'shards'))
+        with open(os.path.join(self.dir, 'shards', '%23a.json'), 'w') as f:
+            f.write('{"m1"')
+        db = ShardStore(self.path).load()
+        self.assertNotIn('#a', db)
+        self.assertEqual(db.get('#a'), None)
+        self.assertEqual(list(db), [])
+
+    def testReadBansGivesPermanentBansALiftTime(self):
+        path = os.path.join(self.dir, 'list.txt')
+        with open(path, 'w') as f:
+            f.write('*!*@a.example.com why\n')
+        with open(path) as f:
+            self.assertEqual(list(readBans(f, 'text', 'me', 'default', 100, 200)),
+                             [('*!*@a.example.com', ['me', 100, 'why', 200, False])])
+
+    def testWriterCoalescesWrites(self):
+        writes = []
+        class CountingStore(JsonStore):
+            def write(self, snapshot):
+                writes.append(snapshot())
+        state = {'n': 0}
+        writer = DbWriter(CountingStore(self.path), lambda: dict(state), lambda: 0.3)
+        writer.start()
+        for n in range(50):
+            state['n'] = n
+            writer.markDirty()
+        time.sleep(0.6)
+        self.assertEqual(writes, [{'n': 49}])
+        state['n'] = 50
+        writer.markDirty()
+        writer.stop()
+        self.assertEqual(writes[-1], {'n': 50})
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
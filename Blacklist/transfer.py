@@ -0,0 +1,191 @@
+###
+# Blacklist - transfer.py
+#
+# Bulk import and export of banlists: the plugin's own JSON layout, the
+# WeeChat autoban.json kept by WeeChat/Autoban/autoban.py, and plain text
+# with one mask (and optionally a reason) per line.  Input is streamed so
+# a large file never has to be parsed in one piece.
+###
+
+import calendar, json, time
+
+from .storage import validEntry
+
+FORMATS = ('json', 'autoban', 'text')
+# Characters a channel name (or the network list's key, '*') may start with
+CHANNEL_PREFIXES = '#&!+*'
+CHUNK = 65536
+
+_decoder = json.JSONDecoder()
+
+
+class JsonReader(object):
+    """Reads a JSON document from a file a chunk at a time"""
+
+    def __init__(self, f):
+        self.f = f
+        self.buf = ''
+        self.pos = 0
+
+    def _more(self):
+        data = self.f.read(CHUNK)
+        if not data:
+            return False
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Return the next non-whitespace character without consuming it"""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._more():
+                raise ValueError('unexpected end of file')
+
+    def expect(self, c):
+        if self.peek() != c:
+            raise ValueError(f'expected {c!r}, found {self.peek()!r}')
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                (value, end) = _decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if self._more():
+                    continue
+                raise
+            # A number may go on in the next chunk
+            if end == len(self.buf) and self._more():
+                continue
+            self.pos = end
+            return value
+
+    def pairs(self, depth=1, path=()):
+        """Yield (keys, value) for the values depth objects deep, keys
+        being the tuple of keys leading to each"""
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            if not isinstance(key, str):
+                raise ValueError('object keys must be strings')
+            self.expect(':')
+            if depth > 1:
+                yield from self.pairs(depth - 1, path + (key,))
+            else:
+                yield (path + (key,), self.value())
+            c = self.peek()
+            self.pos += 1
+            if c == '}':
+                return
+            if c != ',':
+                raise ValueError(f'expected \',\' or \'}}\', found {c!r}')
+
+
+def detect(f):
+    """Guess the format of the file f from its start, and rewind it"""
+    start = f.read(CHUNK)
+    f.seek(0)
+    text = start.lstrip()
+    if not text.startswith('{'):
+        return 'text'
+    try:
+        (key, end) = _decoder.raw_decode(text, len(text) - len(text[1:].lstrip()))
+    except ValueError:
+        # Empty object, or a first key longer than a chunk
+        return 'json'
+    if not isinstance(key, str):
+        return 'json'
+    # autoban.json files nicks and masks, which may start with '*' too
+    return 'json' if key[:1] in CHANNEL_PREFIXES and '@' not in key else 'autoban'
+
+
+def _parseTime(stamp, default):
+    """Return the unix time of an autoban '%Y-%m-%d %H:%M:%S UTC' stamp"""
+    try:
+        return calendar.timegm(time.strptime(stamp, '%Y-%m-%d %H:%M:%S UTC'))
+    except (TypeError, ValueError):
+        return default
+
+
+def readBans(f, fmt, banner, reason, now, lift):
+    """Yield (mask, db entry) for every ban in the file f.  banner, reason
+    and lift, when the channel ban of a permanent entry is lifted, fill in
+    what the format does not carry; bans that have already expired are
+    skipped.  Entries of the plugin's own format are passed on
+    as they are, the caller has to validate them."""
+    if fmt == 'text':
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            (mask, why) = (line.split(None, 1) + [''])[:2]
+            yield (mask, [banner, now, why or reason, lift, False])
+    elif fmt == 'json':
+        for ((channel, mask), entry) in JsonReader(f).pairs(2):
+            if validEntry(entry) and len(entry) >= 5 and entry[4] and entry[3] <= now:
+                continue
+            yield (mask, entry)
+    elif fmt == 'autoban':
+        for ((nick,), entry) in JsonReader(f).pairs(1):
+            if not isinstance(entry, dict) or not isinstance(entry.get('masks'), dict):
+                continue
+            for (mask, info) in entry['masks'].items():
+                if not isinstance(info, dict):
+                    continue
+                added = _parseTime(info.get('added'), now)
+                expires = info.get('expires') or 0
+                if not isinstance(expires, (int, float)):
+                    continue
+                if not expires:
+                    yield (mask, [banner, added, f'{reason} ({nick})', lift, False])
+                elif expires > now:
+                    yield (mask, [banner, added, f'{reason} ({nick})', int(expires), True])
+    else:
+        raise ValueError(f'unknown format {fmt}')
+
+
+def _autobanKey(mask):
+    """Return the autoban.json nick entry a mask is filed under: its nick
+    if that is literal, else the mask itself"""
+    nick = mask.split('!', 1)[0]
+    if '!' in mask and nick and '*' not in nick and '?' not in nick:
+        return nick
+    return mask
+
+
+def writeBans(f, fmt, scope, entries, origin):
+    """Write entries ({mask: db entry}) of banlist scope to the file f.
+    origin is the 'network/channel' autoban.json records the bans as
+    applied in."""
+    if fmt == 'text':
+        for (mask, v) in entries.items():
+            f.write(f'{mask} {v[2]}\n')
+    elif fmt == 'json':
+        f.write('{' + json.dumps(scope) + ': {')
+        first = True
+        for (mask, v) in entries.items():
+            f.write(('\n' if first else ',\n') + json.dumps(mask) + ': ' + json.dumps(v))
+            first = False
+        f.write('\n}}\n')
+    elif fmt == 'autoban':
+        nicks = {}
+        for (mask, v) in entries.items():
+            stamp = time.strftime('%Y-%m-%d %H:%M:%S UTC', time.gmtime(v[1]))
+            timed = len(v) >= 5 and v[4]
+            nick = nicks.setdefault(_autobanKey(mask), {'added': stamp, 'masks': {}})
+            nick['added'] = min(nick['added'], stamp)
+            nick['masks'][mask] = {'added': stamp, 'expires': v[3] if timed else 0,
+                                   'channels': [origin]}
+        json.dump(nicks, f, indent=2)
+    else:
+        raise ValueError(f'unknown format {fmt}')
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79: